@@ -7,104 +7,1009 @@ from flask import (
     session,
     flash,
     jsonify,
+    Response,
+    stream_with_context,
+    g,
+    has_app_context,
+    has_request_context,
+)
+from openai import (
+    OpenAI,
+    APIConnectionError,
+    APITimeoutError,
+    DEFAULT_CONNECTION_LIMITS,
+    DefaultHttpxClient,
+    InternalServerError,
+    RateLimitError,
+    Timeout,
 )
-from openai import OpenAI
 from dotenv import load_dotenv
-import sqlite3, os, hashlib, json, requests
-from bs4 import BeautifulSoup
+import sqlite3, os, sys, hashlib, json, math, requests
+import click
+import contextvars
+import functools
+import inspect
+from requests.adapters import HTTPAdapter
+from lxml import etree
 import re
 import time
+import random
 import secrets
+import queue
+import threading
+import unicodedata
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from collections import Counter
+from collections import Counter, OrderedDict, deque
+from itertools import zip_longest
+from types import SimpleNamespace
 
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
-# 建立一個 OpenAI 客戶端實例
-client = OpenAI(api_key=api_key)
 app = Flask(__name__)
 app.secret_key = secrets.token_hex(32)
-DB_NAME = "users.db"
+DB_NAME = os.getenv("DB_NAME", "users.db")
+
+# SQLite 連線設定：WAL 讓教師儀表板的長時間讀取不會擋住學生寫入
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "8"))
+SQLITE_PRAGMAS = {
+    "synchronous": "NORMAL",  # WAL 下 NORMAL 已可保證資料庫一致性
+    "busy_timeout": 5000,  # 毫秒，遇到寫入鎖時等待而不是立刻失敗
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -16000,  # 負值代表 KiB，約 16MB 的頁面快取
+    "temp_store": "MEMORY",
+}
+# /chat 流程模式："two_call"（先分析再回答，兩次 GPT 呼叫）、"fused"（一次呼叫完成）
+# 或 "speculative"（分析的同時以預測的鷹架類型先產生回覆）
+CHAT_PIPELINE_MODE = os.getenv("CHAT_PIPELINE_MODE", "two_call")
 
+# 推測模式使用的執行緒池與統計
+speculation_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("SPECULATION_WORKERS", "8"))
+)
+speculation_lock = threading.Lock()
+speculation_stats = {"hits": 0, "misses": 0, "saved_ms": 0.0}
+
+# 教師儀表板每日活動可選的天數；"semester" 則從本學期開學日（SEMESTER_START，YYYY-MM-DD）起算
+ACTIVITY_WINDOWS = {"7": 7, "30": 30, "90": 90}
+SEMESTER_START = os.getenv("SEMESTER_START")
+
+# 弱點分析：/my_learning_analytics 等待背景工作完成的秒數，0 代表送出工作後立刻回應
+WEAKNESS_DEADLINE_SECONDS = float(os.getenv("WEAKNESS_DEADLINE_SECONDS", "0"))
+# 弱點分析工作重試用盡而失敗後，該單元沒有新對話時在此秒數內直接顯示分析失敗，不再重新排入
+WEAKNESS_FAILED_COOLDOWN_SECONDS = int(
+    os.getenv("WEAKNESS_FAILED_COOLDOWN_SECONDS", "3600")
+)
 
-# 密碼 hash
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+# 背景工作佇列（jobs 資料表）：每個 process 的 worker 執行緒數（0 代表不在此 process 執行工作，
+# 例如另外以 `flask --app app run-jobs` 啟動專用 worker）、重試次數與退避秒數
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_BASE_SECONDS = int(os.getenv("JOB_RETRY_BASE_SECONDS", "30"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "2"))
+# 執行中超過此秒數沒有進度的工作視為 worker 已中斷，重新排入佇列
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", "900"))
+# 完成或失敗的工作保留天數
+JOB_RETENTION_DAYS = int(os.getenv("JOB_RETENTION_DAYS", "7"))
+# 每晚預先計算所有學生弱點分析的時刻（0-23 時），未設定則只能用 CLI 觸發
+NIGHTLY_PRECOMPUTE_HOUR = os.getenv("NIGHTLY_PRECOMPUTE_HOUR")
+job_wakeup = threading.Event()
+job_handlers = {}
+
+# 教師儀表板快取：window -> (資料版本, 小時, ETag, JSON)
+dashboard_cache = {}
+dashboard_cache_lock = threading.Lock()
+
+# 學習單元設定檔（JSON，格式同 LEARNING_UNITS），未設定時使用內建單元表
+LEARNING_UNITS_FILE = os.getenv("LEARNING_UNITS_FILE")
+
+# 書籍推薦：搜尋網址（{keywords} 會代入編碼後的關鍵字，測試時可指向本機伺服器）、
+# 關鍵字→書籍快取的存活秒數（搜尋失敗以較短的時間快取，避免一直重試），以及 HTTP 連線池大小
+BOOK_SEARCH_URL = os.getenv(
+    "BOOK_SEARCH_URL", "https://search.books.com.tw/search/query/key/{keywords}/cat/all"
+)
+BOOK_CACHE_TTL = int(os.getenv("BOOK_CACHE_TTL", str(7 * 24 * 3600)))
+BOOK_NEGATIVE_CACHE_TTL = int(os.getenv("BOOK_NEGATIVE_CACHE_TTL", "600"))
+BOOK_HTTP_POOL_SIZE = int(os.getenv("BOOK_HTTP_POOL_SIZE", "10"))
+# 每次推薦最多回傳幾本書；多個關鍵字時同時搜尋的執行緒數
+BOOK_RESULTS_LIMIT = int(os.getenv("BOOK_RESULTS_LIMIT", "3"))
+book_search_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("BOOK_SEARCH_WORKERS", "4"))
+)
 
+# 書籍推薦關鍵詞：先比對學習單元的關鍵詞，再用歷史提問建立的 TF-IDF 模型，兩者都沒把握才呼叫 GPT。
+# 模型取最近 KEYWORD_CORPUS_LIMIT 則提問、每 KEYWORD_MODEL_TTL 秒在背景重建；
+# 語料少於 KEYWORD_MIN_CORPUS 則提問時不使用，候選詞需出現在至少 KEYWORD_MIN_DF 則、至多 KEYWORD_MAX_DF_RATIO 比例的提問中。
+# 信心度：含此詞的提問中，AI 回覆也提到這個詞的比例（主題詞會被回覆沿用，「老師我想知道」之類的贅詞不會），
+# 低於 KEYWORD_MIN_CONFIDENCE 的詞不採用
+KEYWORD_CORPUS_LIMIT = int(os.getenv("KEYWORD_CORPUS_LIMIT", "5000"))
+KEYWORD_MODEL_TTL = int(os.getenv("KEYWORD_MODEL_TTL", "3600"))
+KEYWORD_MIN_CORPUS = int(os.getenv("KEYWORD_MIN_CORPUS", "100"))
+KEYWORD_MIN_DF = int(os.getenv("KEYWORD_MIN_DF", "3"))
+KEYWORD_MAX_DF_RATIO = float(os.getenv("KEYWORD_MAX_DF_RATIO", "0.3"))
+KEYWORD_MIN_CONFIDENCE = float(os.getenv("KEYWORD_MIN_CONFIDENCE", "0.5"))
+
+# LLM 呼叫：連線與讀取逾時（秒）、失敗重試次數與退避秒數、連續失敗幾次開啟斷路器與冷卻秒數、
+# HTTP 連線池大小。LLM_BASE_URL 可指向相容 OpenAI API 的服務（例如測試用的本機假伺服器）
+LLM_BASE_URL = os.getenv("LLM_BASE_URL") or None
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "30"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BASE_SECONDS = float(os.getenv("LLM_RETRY_BASE_SECONDS", "0.5"))
+LLM_RETRY_MAX_SECONDS = float(os.getenv("LLM_RETRY_MAX_SECONDS", "8"))
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "20"))
+# LLM 呼叫紀錄（llm_calls）：背景批次寫入的間隔秒數與每批筆數、記憶體中最多暫存筆數、保留天數
+LLM_CALLS_FLUSH_SECONDS = float(os.getenv("LLM_CALLS_FLUSH_SECONDS", "2"))
+LLM_CALLS_BATCH_SIZE = int(os.getenv("LLM_CALLS_BATCH_SIZE", "200"))
+LLM_CALLS_BUFFER_SIZE = int(os.getenv("LLM_CALLS_BUFFER_SIZE", "10000"))
+LLM_CALLS_RETENTION_DAYS = int(os.getenv("LLM_CALLS_RETENTION_DAYS", "90"))
+
+# 監控指標：超過 SQLITE_SLOW_QUERY_MS 毫秒的 SQL 記入慢查詢紀錄（保留最近 SLOW_QUERY_LOG_SIZE 筆）；
+# 設定 METRICS_TOKEN 時 /metrics 需要 Authorization: Bearer <token>
+SQLITE_SLOW_QUERY_MS = float(os.getenv("SQLITE_SLOW_QUERY_MS", "100"))
+SLOW_QUERY_LOG_SIZE = int(os.getenv("SLOW_QUERY_LOG_SIZE", "200"))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+# 鷹架回覆快取：最多保留幾筆、每筆存活秒數
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "512"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+
+# 學習歷史快取（每個 worker 各一份）：最近 USER_HISTORY_LIMIT 筆，記憶體上限與存活秒數。
+# 多個 worker 時其他 worker 的寫入不會通知本 worker，因此以 TTL 限制最久可能落後多久
+USER_HISTORY_LIMIT = 10
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+HISTORY_CACHE_TTL = int(os.getenv("HISTORY_CACHE_TTL", "300"))
+
+# /chat/history 每頁幾輪對話（預設與上限），以及每次 fetchmany 讀取的筆數
+CHAT_HISTORY_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_PAGE_SIZE", "20"))
+CHAT_HISTORY_MAX_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_MAX_PAGE_SIZE", "100"))
+CHAT_HISTORY_FETCH_SIZE = 50
+
+# 清除對話紀錄：/chat/clear 只記錄水位，內容由背景工作分批改寫；
+# 每批最多 CLEAR_SCRUB_BATCH_SIZE 筆、批次間暫停 CLEAR_SCRUB_PAUSE_SECONDS 秒，避免長時間佔用寫入鎖
+CLEARED_MESSAGE = "[已清除]"
+CLEAR_SCRUB_BATCH_SIZE = int(os.getenv("CLEAR_SCRUB_BATCH_SIZE", "200"))
+CLEAR_SCRUB_PAUSE_SECONDS = float(os.getenv("CLEAR_SCRUB_PAUSE_SECONDS", "0.2"))
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape_label(v)}"' for n, v in pairs) + "}"
+
+
+class Histogram:
+    """Prometheus 直方圖：依標籤值分開統計各 bucket 次數、總和與次數，可跨執行緒使用"""
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = sorted(buckets)
+        self._series = {}  # 標籤值 tuple -> [各 bucket 次數..., +Inf 次數, 總和]
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ["+Inf"], series[:-1]):
+                cumulative += count
+                le = bound if bound == "+Inf" else repr(float(bound))
+                lines.append(
+                    f"{self.name}_bucket"
+                    f"{_format_labels(self.label_names, labels, [('le', le)])} {cumulative}"
+                )
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class MetricCounter:
+    """Prometheus 計數器（只增不減），依標籤值分開計數"""
+
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = Counter()
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self._values[labels] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SQL_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+http_request_duration = Histogram(
+    "http_request_duration_seconds",
+    "HTTP 請求處理時間（串流回應只計到開始送出）",
+    ("route", "method", "status"),
+    LATENCY_BUCKETS,
+)
+chat_stage_duration = Histogram(
+    "chat_stage_duration_seconds",
+    "/chat 各階段耗時",
+    ("stage",),
+    LATENCY_BUCKETS,
+)
+sqlite_query_duration = Histogram(
+    "sqlite_query_duration_seconds",
+    "SQL 執行時間（不含 fetch），依語句類型與資料表分組",
+    ("statement",),
+    SQL_BUCKETS,
+)
+sqlite_slow_queries = MetricCounter(
+    "sqlite_slow_queries_total", "超過 SQLITE_SLOW_QUERY_MS 的 SQL 次數", ("statement",)
+)
+slow_query_log = deque(maxlen=SLOW_QUERY_LOG_SIZE)
 
-# 資料庫初始化
-def init_db():
-    if not os.path.exists(DB_NAME):
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute(
-            """CREATE TABLE users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL
-            )"""
+
+@contextmanager
+def chat_stage(stage):
+    """記錄 /chat 某個階段的耗時"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        chat_stage_duration.observe((stage,), time.perf_counter() - started)
+
+
+SQL_VERB_PATTERN = re.compile(r"^\s*(\w+)")
+SQL_TABLE_PATTERN = re.compile(
+    r"\b(?:FROM|INTO|UPDATE|TABLE)\s+([A-Za-z_][A-Za-z0-9_]*)", re.IGNORECASE
+)
+
+
+@functools.lru_cache(maxsize=1024)
+def sql_statement_label(sql):
+    """「SELECT conversations」這類低基數的標籤，避免把整段 SQL 當成指標標籤"""
+    verb = SQL_VERB_PATTERN.match(sql)
+    verb = verb.group(1).upper() if verb else "?"
+    table = SQL_TABLE_PATTERN.search(sql)
+    return f"{verb} {table.group(1)}" if table else verb
+
+
+def observe_sql(sql, seconds):
+    label = sql_statement_label(sql)
+    sqlite_query_duration.observe((label,), seconds)
+    elapsed_ms = seconds * 1000
+    if elapsed_ms >= SQLITE_SLOW_QUERY_MS:
+        sqlite_slow_queries.inc((label,))
+        statement = " ".join(sql.split())
+        slow_query_log.append(
+            {
+                "at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "ms": round(elapsed_ms, 1),
+                "statement": label,
+                "sql": statement[:2000],
+            }
         )
-        c.execute(
-            """CREATE TABLE conversations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL,
-                user_message TEXT NOT NULL,
-                bot_reply TEXT NOT NULL,
-                learning_unit TEXT,
-                scaffolding_type TEXT,
-                understanding_level TEXT,
-                analysis_reason TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )"""
+        print(f"慢查詢 {elapsed_ms:.1f}ms [{label}]: {statement[:500]}")
+
+
+class TimedCursor(sqlite3.Cursor):
+    """記錄每次 execute / executemany 的耗時"""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            observe_sql(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            observe_sql(sql, time.perf_counter() - started)
+
+
+class TimedConnection(sqlite3.Connection):
+    """cursor()、execute() 與 executemany() 都經過 TimedCursor"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+# 目前執行中的 LLM 呼叫點：{"call_site", "username", "records"}，由 llm_call_site 設定
+_llm_call_context = contextvars.ContextVar("llm_call_context", default=None)
+
+
+class LLMCallRecorder:
+    """
+    LLM 呼叫紀錄先放在記憶體佇列，由背景執行緒每 flush_seconds 秒或累積 batch_size 筆時
+    一次寫入 llm_calls，請求本身不等資料庫。佇列滿了就丟棄並計數。
+    """
+
+    def __init__(self, flush_seconds, batch_size, buffer_size):
+        self.flush_seconds = flush_seconds
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=buffer_size)
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.written = 0
+        self.dropped = 0
+
+    def record(self, context, model, latency_ms, usage, outcome, defer=True):
+        """
+        建立一筆紀錄。在 llm_call_site 範圍內（defer=True）時先留在該範圍，
+        範圍結束才送出，期間呼叫端可以用 mark_llm_parse_failure 改成 parse_fail。
+        """
+        if context is None:
+            context = {"call_site": "unknown", "username": None, "records": None}
+        row = [
+            time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),  # 與 CURRENT_TIMESTAMP 同為 UTC
+            context["call_site"],
+            model,
+            context["username"],
+            getattr(usage, "prompt_tokens", None),
+            getattr(usage, "completion_tokens", None),
+            round(latency_ms, 1),
+            outcome,
+        ]
+        if defer and context["records"] is not None:
+            context["records"].append(row)
+        else:
+            self.add(row)
+
+    def add(self, row):
+        try:
+            self._queue.put_nowait(tuple(row))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return
+        self._ensure_thread()
+        if self._queue.qsize() >= self.batch_size:
+            self._wakeup.set()
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="llm-call-recorder", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        rows = []
+        while True:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if not rows:
+            return 0
+
+        try:
+            with db_connection() as conn:
+                conn.executemany(
+                    """INSERT INTO llm_calls 
+                       (created_at, call_site, model, username, prompt_tokens, 
+                        completion_tokens, latency_ms, outcome) 
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                    rows,
+                )
+                conn.commit()
+        except sqlite3.Error as e:
+            print(f"LLM 呼叫紀錄寫入錯誤（{len(rows)} 筆）: {e}")
+            with self._lock:
+                self.dropped += len(rows)
+            return 0
+
+        with self._lock:
+            self.written += len(rows)
+        return len(rows)
+
+
+llm_call_recorder = LLMCallRecorder(
+    LLM_CALLS_FLUSH_SECONDS, LLM_CALLS_BATCH_SIZE, LLM_CALLS_BUFFER_SIZE
+)
+
+
+def llm_call_site(name):
+    """
+    標記函式中的 LLM 呼叫屬於哪個呼叫點，記錄到 llm_calls。
+    學生為函式的 username 參數，沒有時取目前登入的使用者。
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        def open_context(args, kwargs):
+            bound = signature.bind_partial(*args, **kwargs)
+            username = bound.arguments.get("username")
+            if username is None and has_request_context():
+                username = session.get("username")
+            return {"call_site": name, "username": username, "records": []}
+
+        def close_context(context):
+            for row in context["records"]:
+                llm_call_recorder.add(row)
+
+        if inspect.isgeneratorfunction(func):
+
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                context = open_context(args, kwargs)
+                token = _llm_call_context.set(context)
+                try:
+                    yield from func(*args, **kwargs)
+                finally:
+                    _llm_call_context.reset(token)
+                    close_context(context)
+
+            return generator_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            context = open_context(args, kwargs)
+            token = _llm_call_context.set(context)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _llm_call_context.reset(token)
+                close_context(context)
+
+        return wrapper
+
+    return decorator
+
+
+def mark_llm_parse_failure():
+    """呼叫成功但回覆無法解析：把目前呼叫點最後一筆成功的紀錄改為 parse_fail"""
+    context = _llm_call_context.get()
+    if context and context["records"] and context["records"][-1][7] == "ok":
+        context["records"][-1][7] = "parse_fail"
+
+
+class LLMUnavailableError(Exception):
+    """斷路器開啟中，暫時不呼叫 LLM"""
+
+
+class ResilientLLMClient:
+    """
+    包裝 OpenAI 相容的客戶端（backend），介面同 client.chat.completions.create。
+    連線錯誤、逾時、429 與 5xx 以指數退避加隨機抖動重試；重試後仍失敗的呼叫連續達到門檻時開啟斷路器，
+    冷卻期間直接丟出 LLMUnavailableError，冷卻結束後放行一次試探呼叫，成功才恢復。
+    """
+
+    RETRYABLE_ERRORS = (APIConnectionError, APITimeoutError, RateLimitError, InternalServerError)
+
+    def __init__(
+        self,
+        backend,
+        max_retries=LLM_MAX_RETRIES,
+        retry_base_seconds=LLM_RETRY_BASE_SECONDS,
+        retry_max_seconds=LLM_RETRY_MAX_SECONDS,
+        breaker_threshold=LLM_BREAKER_THRESHOLD,
+        breaker_cooldown=LLM_BREAKER_COOLDOWN,
+        recorder=None,
+    ):
+        self.backend = backend
+        self.recorder = recorder
+        self.max_retries = max_retries
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._opened_at = None  # 斷路器開啟的時間，None 代表關閉
+        self._probing = False
+        self._counters = Counter()
+
+    def _before_call(self):
+        """斷路器開啟時丟出例外；冷卻結束後放行的試探呼叫回傳 True"""
+        with self._lock:
+            self._counters["calls"] += 1
+            if self._opened_at is None:
+                return False
+            if self._probing or time.monotonic() - self._opened_at < self.breaker_cooldown:
+                self._counters["short_circuited"] += 1
+                raise LLMUnavailableError("LLM 服務暫時無法使用，請稍後再試")
+            self._probing = True
+            return True
+
+    def _after_call(self, provider_ok):
+        with self._lock:
+            self._probing = False
+            if provider_ok:
+                self._consecutive_failures = 0
+                self._opened_at = None
+                return
+
+            self._counters["failures"] += 1
+            self._consecutive_failures += 1
+            if self._opened_at is not None or self._consecutive_failures >= self.breaker_threshold:
+                if self._opened_at is None:
+                    self._counters["breaker_opened"] += 1
+                    print(f"LLM 連續失敗 {self._consecutive_failures} 次，斷路器開啟")
+                self._opened_at = time.monotonic()
+
+    def create(self, **kwargs):
+        """呼叫 LLM 並記錄延遲（含重試）、token 用量與結果；串流在讀完後才記錄"""
+        context = _llm_call_context.get()
+        started = time.perf_counter()
+        try:
+            response = self._create_with_retries(**kwargs)
+        except Exception:
+            self._record(context, kwargs, started, None, "error")
+            raise
+
+        if kwargs.get("stream"):
+            return self._recorded_stream(context, kwargs, started, response)
+
+        self._record(context, kwargs, started, getattr(response, "usage", None), "ok")
+        return response
+
+    def _recorded_stream(self, context, kwargs, started, stream):
+        usage = None
+        outcome = "error"
+        try:
+            for chunk in stream:
+                usage = getattr(chunk, "usage", None) or usage
+                yield chunk
+            outcome = "ok"
+        finally:
+            self._record(context, kwargs, started, usage, outcome, defer=False)
+
+    def _record(self, context, kwargs, started, usage, outcome, defer=True):
+        if self.recorder is None:
+            return
+        latency_ms = (time.perf_counter() - started) * 1000
+        self.recorder.record(
+            context, kwargs.get("model"), latency_ms, usage, outcome, defer=defer
         )
 
-        # 添加預設的teacher帳號
-        teacher_password = hash_password("teacher")  # 密碼也是teacher
-        c.execute(
-            "INSERT INTO users (username, password) VALUES (?, ?)",
-            ("teacher", teacher_password),
+    def _create_with_retries(self, **kwargs):
+        # 試探呼叫不重試，服務仍異常時盡快再次開啟斷路器
+        max_retries = 0 if self._before_call() else self.max_retries
+        for attempt in range(max_retries + 1):
+            try:
+                response = self.backend.chat.completions.create(**kwargs)
+            except self.RETRYABLE_ERRORS:
+                if attempt == max_retries:
+                    self._after_call(False)
+                    raise
+                with self._lock:
+                    self._counters["retries"] += 1
+                # full jitter：避免大量請求在同一時間一起重試
+                delay = min(self.retry_max_seconds, self.retry_base_seconds * 2**attempt)
+                time.sleep(random.uniform(0, delay))
+            except Exception:
+                # 400、驗證失敗等錯誤重試也不會成功，但代表服務本身正常
+                self._after_call(True)
+                raise
+            else:
+                self._after_call(True)
+                return response
+
+    def stats(self):
+        with self._lock:
+            if self._opened_at is None:
+                state = "closed"
+            elif time.monotonic() - self._opened_at < self.breaker_cooldown:
+                state = "open"
+            else:
+                state = "half_open"
+            return dict(
+                self._counters,
+                state=state,
+                consecutive_failures=self._consecutive_failures,
+            )
+
+
+def create_llm_backend():
+    """OpenAI 客戶端：明確的連線/讀取逾時與連線池大小，重試交給 ResilientLLMClient"""
+    limits = type(DEFAULT_CONNECTION_LIMITS)(
+        max_connections=LLM_POOL_SIZE, max_keepalive_connections=LLM_POOL_SIZE
+    )
+    return OpenAI(
+        api_key=api_key,
+        base_url=LLM_BASE_URL,
+        timeout=Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+        max_retries=0,
+        http_client=DefaultHttpxClient(limits=limits),
+    )
+
+
+# 全程式共用的 LLM 客戶端
+client = ResilientLLMClient(create_llm_backend(), recorder=llm_call_recorder)
+
+
+# 資料庫連線池：每個 worker 共用一組已設定好 PRAGMA 的連線，避免每個請求重新連線
+class ConnectionPool:
+    """SQLite 連線池，閒置連線放在 LIFO 佇列，用完歸還；超過容量的連線歸還時直接關閉"""
+
+    def __init__(self, db_name, size):
+        self.db_name = db_name
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_name, check_same_thread=False, factory=TimedConnection
         )
+        conn.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+        for name, value in SQLITE_PRAGMAS.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn):
+        # 未提交的交易一律回滾，避免下一個使用者拿到半途的狀態
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+
+def get_db_pool():
+    """取得目前 DB_NAME 的連線池（第一次使用時才建立）"""
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None or _db_pool.db_name != DB_NAME:
+            if _db_pool is not None:
+                _db_pool.close_all()
+            _db_pool = ConnectionPool(DB_NAME, SQLITE_POOL_SIZE)
+        return _db_pool
+
+
+def get_db():
+    """取得本次請求共用的資料庫連線，請求結束時自動歸還連線池"""
+    if "db" not in g:
+        g.db = get_db_pool().acquire()
+    return g.db
+
+
+@contextmanager
+def db_connection():
+    """在請求外（背景執行緒、啟動流程）向連線池借用連線"""
+    if has_app_context():
+        yield get_db()
+        return
+
+    pool = get_db_pool()
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+@app.teardown_appcontext
+def release_db(exception):
+    conn = g.pop("db", None)
+    if conn is not None:
+        get_db_pool().release(conn)
+
+
+# 密碼 hash
+def hash_password(password):
+    return hashlib.sha256(password.encode()).hexdigest()
+
+
+# 資料庫版本遷移：每個版本只執行一次，目前版本記錄在 PRAGMA user_version
+def _migrate_base_schema(c):
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL
+        )"""
+    )
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            user_message TEXT NOT NULL,
+            bot_reply TEXT NOT NULL,
+            learning_unit TEXT,
+            scaffolding_type TEXT,
+            understanding_level TEXT,
+            analysis_reason TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )"""
+    )
+
+    # 舊版資料庫可能缺少鷹架分析相關欄位
+    c.execute("PRAGMA table_info(conversations)")
+    columns = [column[1] for column in c.fetchall()]
+
+    new_columns = [
+        ("learning_unit", "TEXT"),
+        ("scaffolding_type", "TEXT"),
+        ("understanding_level", "TEXT"),
+        ("analysis_reason", "TEXT"),
+    ]
+
+    for col_name, col_type in new_columns:
+        if col_name not in columns:
+            c.execute(f"ALTER TABLE conversations ADD COLUMN {col_name} {col_type}")
+            print(f"已新增欄位: {col_name}")
+
+
+def _migrate_conversation_indexes(c):
+    # 個人歷史、對話紀錄、個人分析：WHERE username = ? ORDER BY timestamp
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_conversations_username_timestamp "
+        "ON conversations (username, timestamp)"
+    )
+    # 教師儀表板的時間範圍查詢（活躍學生、每日活動）
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_conversations_timestamp "
+        "ON conversations (timestamp)"
+    )
+    # 每位學生各單元的統計
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_conversations_username_unit "
+        "ON conversations (username, learning_unit)"
+    )
+
+
+def _migrate_student_summary(c):
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS student_summary (
+            username TEXT PRIMARY KEY,
+            total_conversations INTEGER NOT NULL DEFAULT 0,
+            latest_level TEXT,
+            last_activity DATETIME
+        )"""
+    )
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS student_counts (
+            username TEXT NOT NULL,
+            dimension TEXT NOT NULL,
+            value TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (username, dimension, value)
+        )"""
+    )
+    rebuild_student_summary(c)
+
+
+def _migrate_daily_activity(c):
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS daily_activity (
+            day TEXT NOT NULL,
+            learning_unit TEXT NOT NULL DEFAULT '',
+            scaffolding_type TEXT NOT NULL DEFAULT '',
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, learning_unit, scaffolding_type)
+        )"""
+    )
+    rebuild_daily_activity(c)
+
+
+def _migrate_app_state(c):
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS app_state (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )"""
+    )
+    c.execute("INSERT OR IGNORE INTO app_state (key, value) VALUES ('data_version', 0)")
+
+
+def _migrate_weakness_cache(c):
+    # last_conversation_id 是產生這份分析時該單元最新的對話 id
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS weakness_cache (
+            username TEXT NOT NULL,
+            learning_unit TEXT NOT NULL,
+            last_conversation_id INTEGER NOT NULL,
+            result TEXT NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (username, learning_unit)
+        )"""
+    )
+
+
+def _migrate_jobs(c):
+    # status: queued / running / done / failed；checkpoint 讓長時間工作中斷後可從上次進度繼續
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL DEFAULT '{}',
+            owner TEXT,
+            dedupe_key TEXT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            run_after DATETIME DEFAULT CURRENT_TIMESTAMP,
+            checkpoint TEXT,
+            last_error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )"""
+    )
+    # 同一個 dedupe_key 同時只會有一個排隊中或執行中的工作
+    c.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_active_dedupe "
+        "ON jobs (dedupe_key) WHERE status IN ('queued', 'running')"
+    )
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_jobs_status_run_after ON jobs (status, run_after)"
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_owner ON jobs (owner, kind, status)")
+
+
+def _migrate_book_cache(c):
+    # keywords 為正規化後的關鍵字；ok = 0 表示搜尋失敗的負快取
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS book_cache (
+            keywords TEXT PRIMARY KEY,
+            books TEXT NOT NULL,
+            ok INTEGER NOT NULL DEFAULT 1,
+            fetched_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            expires_at DATETIME NOT NULL
+        )"""
+    )
+
+
+def _migrate_llm_calls(c):
+    # outcome: ok / parse_fail / error；latency_ms 含重試時間
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS llm_calls (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at DATETIME NOT NULL,
+            call_site TEXT NOT NULL,
+            model TEXT,
+            username TEXT,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            latency_ms REAL NOT NULL,
+            outcome TEXT NOT NULL
+        )"""
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_llm_calls_created_at ON llm_calls (created_at)")
+
+
+def _migrate_history_index(c):
+    # /chat/history 以 id 為游標分頁：WHERE username = ? AND id < ? ORDER BY id DESC
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_conversations_username_id "
+        "ON conversations (username, id)"
+    )
+
 
+def _migrate_chat_clear_marks(c):
+    # id 小於 cleared_before_id 的對話已被使用者清除，內容不再顯示；
+    # id 小於 scrubbed_before_id 的對話內容已實際改寫為 CLEARED_MESSAGE
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS chat_clear_marks (
+            username TEXT PRIMARY KEY,
+            cleared_before_id INTEGER NOT NULL,
+            scrubbed_before_id INTEGER NOT NULL DEFAULT 0,
+            cleared_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )"""
+    )
+
+
+MIGRATIONS = [
+    (1, "建立 users / conversations 資料表", _migrate_base_schema),
+    (2, "conversations 常用查詢索引", _migrate_conversation_indexes),
+    (3, "學生摘要表 student_summary / student_counts", _migrate_student_summary),
+    (4, "每日活動彙總表 daily_activity", _migrate_daily_activity),
+    (5, "資料版本 app_state", _migrate_app_state),
+    (6, "弱點分析快取 weakness_cache", _migrate_weakness_cache),
+    (7, "背景工作佇列 jobs", _migrate_jobs),
+    (8, "書籍搜尋快取 book_cache", _migrate_book_cache),
+    (9, "LLM 呼叫紀錄 llm_calls", _migrate_llm_calls),
+    (10, "對話紀錄分頁索引", _migrate_history_index),
+    (11, "清除紀錄水位 chat_clear_marks", _migrate_chat_clear_marks),
+]
+
+
+def migrate_db(conn):
+    """依序執行尚未套用的遷移，全部包在同一個寫入交易中"""
+    c = conn.cursor()
+    # IMMEDIATE 先取得寫入鎖，多個 worker 同時啟動時只有一個會真的執行遷移
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        current = c.execute("PRAGMA user_version").fetchone()[0]
+        for version, description, migrate in MIGRATIONS:
+            if version <= current:
+                continue
+            migrate(c)
+            c.execute(f"PRAGMA user_version = {version}")
+            print(f"資料庫遷移 v{version}: {description}")
         conn.commit()
-        conn.close()
-        print("資料庫初始化完成，已創建teacher帳號")
-    else:
-        # 檢查是否需要更新資料庫結構
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
+    except Exception:
+        conn.rollback()
+        raise
 
+
+# 資料庫初始化（在模組載入時執行，gunicorn 部署也會套用）
+def init_db():
+    with db_connection() as conn:
+        migrate_db(conn)
+
+        c = conn.cursor()
         # 檢查teacher帳號是否存在
         c.execute("SELECT * FROM users WHERE username = 'teacher'")
         teacher_exists = c.fetchone()
 
         if not teacher_exists:
-            teacher_password = hash_password("teacher")
+            teacher_password = hash_password("teacher")  # 密碼也是teacher
             c.execute(
                 "INSERT INTO users (username, password) VALUES (?, ?)",
                 ("teacher", teacher_password),
             )
+            conn.commit()
             print("已添加teacher帳號")
 
-        # 檢查是否有新的欄位
-        c.execute("PRAGMA table_info(conversations)")
-        columns = [column[1] for column in c.fetchall()]
-
-        new_columns = [
-            ("learning_unit", "TEXT"),
-            ("scaffolding_type", "TEXT"),
-            ("understanding_level", "TEXT"),
-            ("analysis_reason", "TEXT"),
-        ]
-
-        for col_name, col_type in new_columns:
-            if col_name not in columns:
-                c.execute(f"ALTER TABLE conversations ADD COLUMN {col_name} {col_type}")
-                print(f"已新增欄位: {col_name}")
-
-        conn.commit()
-        conn.close()
-
 
 ###########################################################################  => home
 # 登入註冊畫面
@@ -120,14 +1025,13 @@ def login():
         username = request.form["username"]
         password = hash_password(request.form["password"])
 
-        conn = sqlite3.connect(DB_NAME)
+        conn = get_db()
         c = conn.cursor()
         c.execute(
             "SELECT * FROM users WHERE username = ? AND password = ?",
             (username, password),
         )
         user = c.fetchone()
-        conn.close()
 
         if user:
             session["username"] = username
@@ -150,14 +1054,13 @@ def register():
         username = request.form["username"]
         password = hash_password(request.form["password"])
         try:
-            conn = sqlite3.connect(DB_NAME)
+            conn = get_db()
             c = conn.cursor()
             c.execute(
                 "INSERT INTO users (username, password) VALUES (?, ?)",
                 (username, password),
             )
             conn.commit()
-            conn.close()
             flash("註冊成功，請登入！", "alert alert-success")
             return render_template("home.html")
         except sqlite3.IntegrityError:
@@ -284,22 +1187,143 @@ LEARNING_UNITS = {
 }
 
 
+class KeywordMatcher:
+    """Aho-Corasick 自動機：掃描一次文字就找出所有關鍵詞的出現位置"""
+
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+
+        # 建立 trie
+        for index, pattern in enumerate(patterns):
+            node = 0
+            for ch in pattern:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                node = nxt
+            self._out[node].append(index)
+
+        # BFS 建立失敗連結，並把後綴節點的輸出合併進來
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def iter_matches(self, text):
+        """依序產生 (起始位置, pattern 索引)"""
+        node = 0
+        for pos, ch in enumerate(text):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            for index in self._out[node]:
+                yield pos - len(self.patterns[index]) + 1, index
+
+
+def build_unit_matcher(units):
+    """由單元表建立 (自動機, 每個 pattern 對應的單元索引, 單元名稱)"""
+    unit_names = list(units)
+    pattern_units = {}
+    for unit_index, unit in enumerate(unit_names):
+        for word in [unit] + units[unit]["keywords"]:
+            word = word.lower()
+            if word and unit_index not in pattern_units.setdefault(word, []):
+                pattern_units[word].append(unit_index)
+
+    patterns = list(pattern_units)
+    return (
+        KeywordMatcher(patterns),
+        [pattern_units[p] for p in patterns],
+        unit_names,
+    )
+
+
+_unit_matcher = build_unit_matcher(LEARNING_UNITS)
+
+
+def load_learning_units(path):
+    """從 JSON 設定檔重新載入單元表，並重建關鍵詞自動機"""
+    global _unit_matcher
+
+    with open(path, encoding="utf-8") as f:
+        units = json.load(f)
+
+    matcher = build_unit_matcher(units)
+    LEARNING_UNITS.clear()
+    LEARNING_UNITS.update(units)
+    _unit_matcher = matcher
+    print(f"已載入 {len(units)} 個學習單元: {path}")
+
+
+if LEARNING_UNITS_FILE:
+    load_learning_units(LEARNING_UNITS_FILE)
+
+
 # 從對話去猜，使用者有問題的單元
 def identify_learning_unit(user_message):
-    """識別使用者訊息中的學習單元"""
-    message_lower = user_message.lower()
+    """
+    識別使用者訊息中的學習單元。
+    所有命中的單元名稱與關鍵詞都會計分（分數 = 命中字數總和），
+    同分時依序比較：最早出現位置、單元表中的順序。
+    """
+    matcher, pattern_units, unit_names = _unit_matcher
+
+    scores = {}
+    for start, index in matcher.iter_matches(user_message.lower()):
+        length = len(matcher.patterns[index])
+        for unit_index in pattern_units[index]:
+            score, first = scores.get(unit_index, (0, start))
+            scores[unit_index] = (score + length, min(first, start))
 
-    for unit, info in LEARNING_UNITS.items():
-        # 檢查單元名稱
-        if unit.lower() in message_lower:
-            return unit
+    if not scores:
+        return "通用概念"  # 預設單元
 
-        # 檢查關鍵詞
-        for keyword in info["keywords"]:
-            if keyword.lower() in message_lower:
-                return unit
+    best = min(scores, key=lambda u: (-scores[u][0], scores[u][1], u))
+    return unit_names[best]
 
-    return "通用概念"  # 預設單元
+
+def identify_learning_units(messages):
+    """批次識別多則訊息的學習單元"""
+    return [identify_learning_unit(message or "") for message in messages]
+
+
+# 批次分類訊息（教師用，可用來重新標記歷史對話）
+@app.route("/admin/learning_units/classify", methods=["POST"])
+def classify_learning_units():
+    if "username" not in session or session["username"] != "teacher":
+        return jsonify({"error": "無權限"}), 403
+
+    messages = (request.json or {}).get("messages", [])
+    return jsonify({"units": identify_learning_units(messages)})
+
+
+# 重新載入單元設定檔
+@app.route("/admin/learning_units/reload", methods=["POST"])
+def reload_learning_units():
+    if "username" not in session or session["username"] != "teacher":
+        return jsonify({"error": "無權限"}), 403
+    if not LEARNING_UNITS_FILE:
+        return jsonify({"error": "未設定 LEARNING_UNITS_FILE"}), 400
+
+    try:
+        load_learning_units(LEARNING_UNITS_FILE)
+    except (OSError, ValueError) as e:
+        return jsonify({"error": str(e)}), 500
+
+    return jsonify({"success": True, "units": len(LEARNING_UNITS)})
 
 
 # 儲存聊天資料 - 加入鷹架理論分析API
@@ -312,55 +1336,398 @@ def chat():
     user_message = request.json.get("message")
 
     try:
-        learning_unit = identify_learning_unit(user_message)
-        user_history = get_user_learning_history(username)
+        with chat_stage("identify_unit"):
+            learning_unit = identify_learning_unit(user_message)
+        with chat_stage("load_history"):
+            user_history = get_user_learning_history(username)
 
-        scaffolding_type, understanding_level, analysis_reason = (
-            analyze_scaffolding_need(
+        scaffolding_type, understanding_level, analysis_reason, reply = (
+            run_scaffolding_pipeline(
                 user_message, learning_unit, user_history, username
             )
         )
 
-        # 再次確保正確格式
-        scaffolding_type = normalize_scaffolding_type(scaffolding_type)
+        with chat_stage("insert"):
+            conversation_id = save_conversation(
+                username,
+                user_message,
+                reply,
+                learning_unit,
+                scaffolding_type,
+                understanding_level,
+                analysis_reason,
+            )
 
-        reply = generate_scaffolded_response(
-            user_message, learning_unit, scaffolding_type, understanding_level
+        return jsonify(
+            {
+                "reply": reply,
+                "learning_unit": learning_unit,
+                "scaffolding_type": scaffolding_type,
+                "understanding_level": understanding_level,
+                "analysis_reason": analysis_reason,
+                "conversation_id": conversation_id,
+            }
+        )
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+# 串流版聊天API（Server-Sent Events），邊產生邊推送文字
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    if "username" not in session:
+        return jsonify({"error": "未登入"}), 401
+
+    username = session["username"]
+    user_message = request.json.get("message")
+
+    def generate():
+        # 先送出一個事件，讓瀏覽器立即收到第一個位元組
+        yield _sse_event("start", {})
+
+        try:
+            learning_unit = identify_learning_unit(user_message)
+            user_history = get_user_learning_history(username)
+
+            # 串流需要純文字回覆，因此固定走兩段式流程（不使用合併模式）
+            scaffolding_type, understanding_level, analysis_reason = (
+                analyze_scaffolding_need(
+                    user_message, learning_unit, user_history, username
+                )
+            )
+            scaffolding_type = normalize_scaffolding_type(scaffolding_type)
+
+            yield _sse_event(
+                "meta",
+                {
+                    "learning_unit": learning_unit,
+                    "scaffolding_type": scaffolding_type,
+                    "understanding_level": understanding_level,
+                    "analysis_reason": analysis_reason,
+                },
+            )
+
+            cache_key = response_cache_key(
+                user_message, learning_unit, scaffolding_type, understanding_level
+            )
+            reply = response_cache.get(cache_key)
+
+            if reply is not None:
+                # 快取命中，整段回覆一次送出
+                yield _sse_event("token", {"text": reply})
+            else:
+                parts = []
+                completed = True
+                try:
+                    for token in stream_scaffolded_response(
+                        user_message, learning_unit, scaffolding_type, understanding_level
+                    ):
+                        parts.append(token)
+                        yield _sse_event("token", {"text": token})
+                except Exception:
+                    completed = False  # 錯誤已在 stream_scaffolded_response 記錄
+
+                # 最後一段收到後才做完整句子與程式碼區塊的處理
+                raw = "".join(parts)
+                if raw and completed:
+                    reply = format_code_blocks(_postprocess_complete_sentences(raw))
+                    response_cache.set(cache_key, reply)
+                else:
+                    # 沒有內容或中途中斷：與非串流版本一樣改用致歉訊息，不儲存半截回覆；
+                    # done 事件的 reply 會取代畫面上已顯示的片段
+                    reply = "抱歉，我遇到了一些技術問題。能請你再說一次你的問題嗎？"
+
+            conversation_id = save_conversation(
+                username,
+                user_message,
+                reply,
+                learning_unit,
+                scaffolding_type,
+                understanding_level,
+                analysis_reason,
+            )
+
+            yield _sse_event(
+                "done",
+                {
+                    "reply": reply,
+                    "learning_unit": learning_unit,
+                    "scaffolding_type": scaffolding_type,
+                    "understanding_level": understanding_level,
+                    "analysis_reason": analysis_reason,
+                    "conversation_id": conversation_id,
+                },
+            )
+
+        except Exception as e:
+            yield _sse_event("error", {"error": str(e)})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def _sse_event(event, data):
+    """組成一筆 SSE 事件"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def save_conversation(
+    username,
+    user_message,
+    reply,
+    learning_unit,
+    scaffolding_type,
+    understanding_level,
+    analysis_reason,
+):
+    """寫入一筆對話紀錄，並在同一個交易中更新學生摘要表與每日彙總表，回傳對話 id"""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute(
+        """
+        INSERT INTO conversations 
+        (username, user_message, bot_reply, learning_unit, scaffolding_type, understanding_level, analysis_reason) 
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """,
+        (
+            username,
+            user_message,
+            reply,
+            learning_unit,
+            scaffolding_type,
+            understanding_level,
+            analysis_reason,
+        ),
+    )
+    conversation_id = c.lastrowid
+    update_student_summary(
+        c,
+        conversation_id,
+        username,
+        learning_unit,
+        scaffolding_type,
+        understanding_level,
+    )
+    update_daily_activity(
+        c, conversation_id, username, learning_unit, scaffolding_type
+    )
+    bump_data_version(c)
+    conn.commit()
+
+    history_cache.append(
+        username, (user_message, learning_unit, scaffolding_type, understanding_level)
+    )
+    return conversation_id
+
+
+# 鷹架回覆快取：同一單元、同鷹架、同理解程度的相同問題直接重用回覆
+class ResponseCache:
+    """有容量上限（LRU 淘汰）與存活時間（TTL）的回覆快取，可跨執行緒使用"""
+
+    def __init__(self, max_size, ttl_seconds):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (寫入時間, 回覆)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl_seconds:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            cleared = len(self._entries)
+            self._entries.clear()
+            return cleared
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 3) if total else 0,
+            }
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+
+class UserHistoryCache:
+    """
+    username -> 最近幾筆 (訊息, 單元, 鷹架類型, 理解程度)，新的在前。
+    第一次查詢時才從資料庫載入，寫入對話時直接加到前面，清除紀錄時作廢；
+    總大小超過 max_bytes 時淘汰最久沒用到的學生。可跨執行緒使用。
+    """
+
+    def __init__(self, limit, max_bytes, ttl_seconds):
+        self.limit = limit
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # username -> (載入時間, deque)
+        self._bytes = 0
+        self._writes = 0  # 載入期間若有寫入或作廢，載入結果不放進快取
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _entry_size(username, items):
+        return sys.getsizeof(username) + sum(
+            sys.getsizeof(field) for item in items for field in item
         )
 
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute(
-            """
-            INSERT INTO conversations 
-            (username, user_message, bot_reply, learning_unit, scaffolding_type, understanding_level, analysis_reason) 
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """,
-            (
-                username,
-                user_message,
-                reply,
-                learning_unit,
-                scaffolding_type,
-                understanding_level,
-                analysis_reason,
-            ),
-        )
-        conn.commit()
-        conn.close()
+    def get(self, username, load):
+        """回傳歷史紀錄（list）；沒有快取時以 load(username) 載入"""
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None and time.monotonic() - entry[0] <= self.ttl_seconds:
+                self._entries.move_to_end(username)
+                self.hits += 1
+                return list(entry[1])
+            if entry is not None:
+                self._remove(username)
+            self.misses += 1
+            writes = self._writes
+
+        history = load(username)
+
+        with self._lock:
+            if writes == self._writes and username not in self._entries:
+                self._store(username, deque(history, maxlen=self.limit))
+        return history
+
+    def append(self, username, item):
+        """寫入一筆新對話；沒有快取的學生不處理，下次查詢時再載入"""
+        with self._lock:
+            self._writes += 1
+            entry = self._entries.get(username)
+            if entry is None:
+                return
+            items = self._remove(username)
+            items.appendleft(item)
+            self._store(username, items, entry[0])
+
+    def invalidate(self, username):
+        with self._lock:
+            self._writes += 1
+            if username in self._entries:
+                self._remove(username)
+
+    def clear(self):
+        with self._lock:
+            self._writes += 1
+            cleared = len(self._entries)
+            self._entries.clear()
+            self._bytes = 0
+            return cleared
+
+    def _store(self, username, items, loaded_at=None):
+        size = self._entry_size(username, items)
+        if self.max_bytes <= 0 or size > self.max_bytes:
+            return
+        self._entries[username] = (loaded_at or time.monotonic(), items)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, username):
+        _, items = self._entries.pop(username)
+        self._bytes -= self._entry_size(username, items)
+        return items
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "users": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 3) if total else 0,
+            }
+
+
+history_cache = UserHistoryCache(
+    USER_HISTORY_LIMIT, HISTORY_CACHE_MAX_BYTES, HISTORY_CACHE_TTL
+)
+
+
+def normalize_message(user_message):
+    """統一全形/半形、大小寫與空白，並去掉句尾標點，作為快取比對用"""
+    text = unicodedata.normalize("NFKC", user_message or "").lower()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip("?!.。！？ ~～")
+
+
+def response_cache_key(
+    user_message, learning_unit, scaffolding_type, understanding_level
+):
+    return (
+        normalize_message(user_message),
+        learning_unit,
+        normalize_scaffolding_type(scaffolding_type),
+        understanding_level,
+    )
+
+
+# 回覆快取統計（教師可查看）
+@app.route("/admin/response_cache")
+def response_cache_stats():
+    if "username" not in session or session["username"] != "teacher":
+        return jsonify({"error": "無權限"}), 403
+    return jsonify(response_cache.stats())
+
+
+# 清空回覆快取
+@app.route("/admin/response_cache/clear", methods=["POST"])
+def clear_response_cache():
+    if "username" not in session or session["username"] != "teacher":
+        return jsonify({"error": "無權限"}), 403
+    return jsonify({"success": True, "cleared": response_cache.clear()})
 
-        return jsonify(
-            {
-                "reply": reply,
-                "learning_unit": learning_unit,
-                "scaffolding_type": scaffolding_type,
-                "understanding_level": understanding_level,
-                "analysis_reason": analysis_reason,
-            }
-        )
 
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+# 學習歷史快取統計（教師可查看，只包含處理這個請求的 worker）
+@app.route("/admin/history_cache")
+def history_cache_stats():
+    if "username" not in session or session["username"] != "teacher":
+        return jsonify({"error": "無權限"}), 403
+    return jsonify(history_cache.stats())
 
 
 # 給出對應的鷹架回應
@@ -387,10 +1754,10 @@ def format_code_blocks(text):
     )
 
 
-def generate_scaffolded_response(
+def build_scaffolding_prompt(
     user_message, learning_unit, scaffolding_type, understanding_level
 ):
-    """根據鷹架類型產生聚焦且可包含程式範例的回覆"""
+    """依鷹架類型與理解程度組出 system prompt"""
 
     # 確保鷹架類型正確
     scaffolding_type = normalize_scaffolding_type(scaffolding_type)
@@ -457,8 +1824,26 @@ def generate_scaffolded_response(
 """,
     }
 
-    system_prompt = scaffolding_prompts.get(
-        scaffolding_type, scaffolding_prompts["差異鷹架"]
+    return scaffolding_prompts.get(scaffolding_type, scaffolding_prompts["差異鷹架"])
+
+
+@llm_call_site("scaffolded_reply")
+def generate_scaffolded_response(
+    user_message, learning_unit, scaffolding_type, understanding_level, username=None
+):
+    """
+    根據鷹架類型產生聚焦且可包含程式範例的回覆。
+    username 只用於 LLM 呼叫紀錄；在沒有請求情境的執行緒（例如推測模式）中呼叫時需明確傳入。
+    """
+    cache_key = response_cache_key(
+        user_message, learning_unit, scaffolding_type, understanding_level
+    )
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    system_prompt = build_scaffolding_prompt(
+        user_message, learning_unit, scaffolding_type, understanding_level
     )
 
     try:
@@ -475,16 +1860,237 @@ def generate_scaffolded_response(
 
         raw = response.choices[0].message.content
         processed = _postprocess_complete_sentences(raw)
-        return format_code_blocks(processed)
+        reply = format_code_blocks(processed)
+        # 只快取成功的回覆，錯誤訊息不進快取
+        response_cache.set(cache_key, reply)
+        return reply
 
     except Exception as e:
         print(f"回應生成錯誤: {e}")
         return "抱歉，我遇到了一些技術問題。能請你再說一次你的問題嗎？"
 
 
+@llm_call_site("scaffolded_reply_stream")
+def stream_scaffolded_response(
+    user_message, learning_unit, scaffolding_type, understanding_level
+):
+    """串流版的鷹架回覆，逐段 yield 模型產生的文字"""
+    system_prompt = build_scaffolding_prompt(
+        user_message, learning_unit, scaffolding_type, understanding_level
+    )
+
+    try:
+        response = client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_message},
+            ],
+            max_tokens=300,
+            temperature=0.35,
+            stop=["[[END]]"],
+            stream=True,
+            stream_options={"include_usage": True},  # 最後一段附上 token 用量
+        )
+
+        for chunk in response:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+
+    except Exception as e:
+        # 重新拋出，讓呼叫端分辨回覆是完整結束還是中途中斷
+        print(f"串流回應生成錯誤: {e}")
+        raise
+
+
 # 推薦書籍 爬蟲
 # 關鍵字提取
+def extract_vocabulary_keywords(user_message, limit=2):
+    """
+    用學習單元的關鍵詞自動機找出訊息中的關鍵詞：優先取較長、較早出現且互不重疊的詞。
+    只命中一般關鍵詞時補上所屬單元名稱，讓書籍搜尋有較明確的主題。
+    """
+    matcher, pattern_units, unit_names = _unit_matcher
+    text = user_message.lower()
+    # lower() 可能改變長度（少數 Unicode 字元），此時改用關鍵詞本身
+    same_length = len(text) == len(user_message)
+
+    matches = sorted(
+        (-len(matcher.patterns[index]), start, index)
+        for start, index in matcher.iter_matches(text)
+    )
+
+    keywords = []
+    spans = []
+    for neg_length, start, index in matches:
+        end = start - neg_length
+        if any(start < e and s < end for s, e in spans):
+            continue
+        word = user_message[start:end] if same_length else matcher.patterns[index]
+        if word.lower() in (k.lower() for k in keywords):
+            continue
+        spans.append((start, end))
+        keywords.append(word)
+        if len(keywords) >= limit:
+            break
+
+    if keywords and len(keywords) < limit:
+        unit = identify_learning_unit(user_message)
+        if unit != "通用概念" and unit.lower() not in (k.lower() for k in keywords):
+            keywords.append(unit)
+
+    return keywords
+
+
+# TF-IDF 候選詞：中文取 2~6 字的片段、英文取整個單字；頭尾是虛詞或疑問詞的片段不當作候選詞
+KEYWORD_TERM_PATTERN = re.compile(r"[\u4e00-\u9fff]+|[a-z][a-z0-9+#\-]+")
+KEYWORD_STOP_CHARS = set("的了嗎呢吧啊是在和與及或跟把被就都也還很沒要會這那哪個些什麼怎如何為請問我你他她它們")
+
+_keyword_model = None  # (建立時間, 提問數, 候選詞 -> 出現在幾則提問, 候選詞 -> 信心度)
+_keyword_model_lock = threading.Lock()
+_keyword_model_building = False
+
+
+def keyword_candidate_terms(message):
+    terms = set()
+    for run in KEYWORD_TERM_PATTERN.findall((message or "").lower()):
+        if run.isascii():
+            terms.add(run)
+            continue
+        for n in range(2, 7):
+            for i in range(len(run) - n + 1):
+                term = run[i : i + n]
+                if term[0] not in KEYWORD_STOP_CHARS and term[-1] not in KEYWORD_STOP_CHARS:
+                    terms.add(term)
+    return terms
+
+
+def build_keyword_model(limit=None):
+    """
+    由最近的提問統計每個候選詞的文件頻率，只保留出現次數夠多的詞；
+    同時統計這些提問的回覆中有多少也提到該詞，作為信心度
+    """
+    with db_connection() as conn:
+        rows = conn.execute(
+            """
+            SELECT user_message, bot_reply 
+            FROM conversations 
+            LEFT JOIN chat_clear_marks m ON m.username = conversations.username 
+            WHERE user_message != ? AND conversations.id >= COALESCE(m.cleared_before_id, 0) 
+            ORDER BY conversations.id DESC 
+            LIMIT ?
+        """,
+            (CLEARED_MESSAGE, limit or KEYWORD_CORPUS_LIMIT),
+        ).fetchall()
+
+    document_frequency = Counter()
+    echoed = Counter()
+    for message, reply in rows:
+        terms = keyword_candidate_terms(message)
+        document_frequency.update(terms)
+        reply = (reply or "").lower()
+        echoed.update(term for term in terms if term in reply)
+
+    kept = {t: df for t, df in document_frequency.items() if df >= KEYWORD_MIN_DF}
+    return (
+        time.monotonic(),
+        len(rows),
+        kept,
+        {t: echoed[t] / df for t, df in kept.items()},
+    )
+
+
+def _refresh_keyword_model():
+    global _keyword_model, _keyword_model_building
+    try:
+        _keyword_model = build_keyword_model()
+    except sqlite3.Error as e:
+        print(f"關鍵詞模型建立錯誤: {e}")
+    finally:
+        _keyword_model_building = False
+
+
+def get_keyword_model():
+    """回傳目前的 TF-IDF 模型；沒有或過期時在背景重建，重建期間沿用舊模型（可能是 None）"""
+    global _keyword_model_building
+    model = _keyword_model
+    if model is not None and time.monotonic() - model[0] < KEYWORD_MODEL_TTL:
+        return model
+
+    with _keyword_model_lock:
+        if _keyword_model_building:
+            return model
+        _keyword_model_building = True
+
+    threading.Thread(target=_refresh_keyword_model, daemon=True).start()
+    return model
+
+
+def extract_tfidf_keywords(user_message, limit=2):
+    """
+    依歷史提問的 TF-IDF 挑出訊息中最具代表性的詞（IDF × 字數，較長的詞優先）。
+    較短的詞若幾乎總是出現在另一個候選詞裡（例如「擬合」之於「過度擬合」）就略過，
+    信心度低於 KEYWORD_MIN_CONFIDENCE 的詞也不採用。
+    模型尚未建立、語料不足或沒有有把握的候選詞時回傳空清單。
+    """
+    model = get_keyword_model()
+    if model is None or model[1] < KEYWORD_MIN_CORPUS:
+        return []
+    _, total, document_frequency, confidence = model
+
+    candidates = {
+        term: document_frequency[term]
+        for term in keyword_candidate_terms(user_message)
+        if term in document_frequency
+        and document_frequency[term] <= total * KEYWORD_MAX_DF_RATIO
+        and confidence[term] >= KEYWORD_MIN_CONFIDENCE
+    }
+    candidates = {
+        term: df
+        for term, df in candidates.items()
+        if not any(
+            term != other and term in other and other_df >= df * 0.7
+            for other, other_df in candidates.items()
+        )
+    }
+
+    ranked = sorted(
+        candidates,
+        key=lambda t: (-math.log(total / candidates[t]) * len(t), t),
+    )
+    keywords = []
+    for term in ranked:
+        if any(term in k or k in term for k in keywords):
+            continue
+        keywords.append(term)
+        if len(keywords) >= limit:
+            break
+    return keywords
+
+
 def extract_keywords_from_message(user_message):
+    """
+    提取用戶訊息中的關鍵詞（1-2 個，以逗號分隔）。
+    依序嘗試單元關鍵詞、TF-IDF，都沒有結果（或 TF-IDF 沒有夠把握的詞）才使用 OpenAI。
+    """
+    keywords = extract_vocabulary_keywords(user_message)
+    if keywords:
+        print("關鍵詞來源: 單元關鍵詞")
+        return ", ".join(keywords)
+
+    keywords = extract_tfidf_keywords(user_message)
+    if keywords:
+        print("關鍵詞來源: TF-IDF")
+        return ", ".join(keywords)
+
+    return extract_keywords_with_llm(user_message)
+
+
+@llm_call_site("keyword_extraction")
+def extract_keywords_with_llm(user_message):
     """使用OpenAI提取用戶訊息中的關鍵詞"""
     try:
         response = client.chat.completions.create(
@@ -506,45 +2112,194 @@ def extract_keywords_from_message(user_message):
         return "機器學習"
 
 
+def create_http_session():
+    """共用的 HTTP session：保持連線（keep-alive），同一主機的請求重複使用連線池"""
+    http = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=BOOK_HTTP_POOL_SIZE, pool_maxsize=BOOK_HTTP_POOL_SIZE
+    )
+    http.mount("https://", adapter)
+    http.mount("http://", adapter)
+    http.headers["User-Agent"] = (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36"
+    )
+    return http
+
+
+http_session = create_http_session()
+
+
 # 書籍爬蟲
 def search_books_google(keywords):
     """使用Google搜索相關書籍"""
     # 將關鍵字編碼，組成搜尋 URL
-    url = f"https://search.books.com.tw/search/query/key/{quote(keywords)}/cat/all"
+    url = BOOK_SEARCH_URL.format(keywords=quote(keywords))
     print(url)
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36"
-    }
 
     # 發送 GET 請求
-    resp = requests.get(url, headers=headers, timeout=10)
+    resp = http_session.get(url, timeout=10)
     resp.raise_for_status()  # 如果有錯誤直接拋出
 
-    soup = BeautifulSoup(resp.text, "html.parser")
-    # 找到 table-td 裡面的 <a> 標籤
-    a_tag = soup.select_one(".table-td a")
-    author = soup.select_one(".author a")
-    img_tag = soup.select_one(".table-td img")
-    if a_tag and a_tag.has_attr("title"):
-        title_text = a_tag["title"]  # 直接取 title 屬性
-        href = a_tag["href"]
-        if img_tag.has_attr("data-src"):  # 懶加載用 data-src
-            img_src = img_tag["data-src"]
-        else:  # 一般情況直接 src
-            img_src = img_tag["src"]
-    books = []
-    books.append(
-        {
-            "title": title_text,
-            "author": author.text,
-            "image": img_src,
-            "link": href,
-            "source": "博客來",
-        }
+    return parse_book_results(resp.text)
+
+
+BOOK_PARSE_CHUNK = 16 * 1024
+
+
+def _find_first_book_item(html):
+    """
+    第一筆搜尋結果（class 含 table-td 的元素）開始標籤的位置，找不到回傳 -1。
+    只接受出現在標籤屬性裡的 table-td，排除 <style> 中的 CSS 選擇器。
+    """
+    pos = html.find("table-td")
+    while pos != -1:
+        window_start = max(0, pos - 512)
+        tag_start = html.rfind("<", window_start, pos)
+        if tag_start > html.rfind(">", window_start, pos) and "class=" in html[tag_start:pos]:
+            return tag_start
+        pos = html.find("table-td", pos + 1)
+    return -1
+
+
+def _has_class(element, name):
+    return name in (element.get("class") or "").split()
+
+
+def _book_from_element(item):
+    """從單一搜尋結果取出書名、作者、封面與連結；沒有書名連結時回傳 None"""
+    title_links = item.xpath(".//a[@title]")
+    if not title_links:
+        return None
+    a_tag = title_links[0]
+
+    img_tag = next(item.iter("img"), None)
+    img_src = ""
+    if img_tag is not None:
+        # 懶加載用 data-src，一般情況直接 src
+        img_src = img_tag.get("data-src") or img_tag.get("src") or ""
+
+    authors = item.xpath(
+        ".//*[contains(concat(' ', normalize-space(@class), ' '), ' author ')]//a"
     )
+
+    return {
+        "title": a_tag.get("title"),
+        "author": "、".join("".join(a.itertext()).strip() for a in authors),
+        "image": img_src,
+        "link": a_tag.get("href"),
+        "source": "博客來",
+    }
+
+
+def _collect_books(parser, books, limit):
+    """讀出解析器目前完成的元素，收集搜尋結果；收滿 limit 本回傳 True"""
+    for _, element in parser.read_events():
+        if not _has_class(element, "table-td"):
+            continue
+        book = _book_from_element(element)
+        if book and all(b["link"] != book["link"] for b in books):
+            books.append(book)
+            if len(books) >= limit:
+                return True
+    return False
+
+
+def parse_book_results(html, limit=None):
+    """
+    用 lxml 解析博客來搜尋結果頁，回傳前 limit 本書，沒有結果時回傳空清單。
+    從第一筆結果開始分段餵給解析器，收滿就停止，頁首的選單與頁尾都不會被解析。
+    """
+    limit = limit or BOOK_RESULTS_LIMIT
+    start = _find_first_book_item(html)
+    if start == -1:
+        return []
+
+    parser = etree.HTMLPullParser(events=("end",))
+    books = []
+    for offset in range(start, len(html), BOOK_PARSE_CHUNK):
+        parser.feed(html[offset : offset + BOOK_PARSE_CHUNK])
+        if _collect_books(parser, books, limit):
+            return books
+
+    parser.close()
+    _collect_books(parser, books, limit)
+    return books
+
+
+def search_books_cached(keywords):
+    """
+    以正規化後的關鍵字查詢 book_cache，過期或沒有才實際搜尋。
+    快取存在資料庫中，重新啟動或多個 worker 之間都共用；搜尋失敗回傳空清單並短暫快取。
+    """
+    key = normalize_message(keywords)
+
+    with db_connection() as conn:
+        row = conn.execute(
+            "SELECT books FROM book_cache WHERE keywords = ? AND expires_at > datetime('now')",
+            (key,),
+        ).fetchone()
+    if row:
+        return json.loads(row[0])
+
+    try:
+        books = search_books_google(keywords)
+        ok = True
+    except Exception as e:
+        print(f"書籍搜尋錯誤 ({keywords}): {e}")
+        books = []
+        ok = False
+
+    ttl = BOOK_CACHE_TTL if ok else BOOK_NEGATIVE_CACHE_TTL
+    with db_connection() as conn:
+        conn.execute(
+            """
+            INSERT INTO book_cache (keywords, books, ok, fetched_at, expires_at)
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP, datetime('now', ?))
+            ON CONFLICT(keywords) DO UPDATE SET
+                books = excluded.books,
+                ok = excluded.ok,
+                fetched_at = excluded.fetched_at,
+                expires_at = excluded.expires_at
+        """,
+            (key, json.dumps(books, ensure_ascii=False), int(ok), f"+{ttl} seconds"),
+        )
+        conn.commit()
+
     return books
 
 
+def split_keywords(keywords):
+    """把「機器學習, 決策樹」拆成個別關鍵字，去掉空白與重複"""
+    parts = (k.strip() for k in re.split(r"[,，、;；]", keywords or ""))
+    return list(dict.fromkeys(k for k in parts if k))
+
+
+def search_books_for_keywords(keywords, limit=None):
+    """
+    每個關鍵字分別搜尋（各自使用快取），多個關鍵字時同時送出。
+    依關鍵字順序輪流取書合併，以連結去除重複，最多回傳 limit 本。
+    """
+    limit = limit or BOOK_RESULTS_LIMIT
+    keyword_list = split_keywords(keywords) or ["機器學習"]
+
+    if len(keyword_list) == 1:
+        results = [search_books_cached(keyword_list[0])]
+    else:
+        results = list(book_search_executor.map(search_books_cached, keyword_list))
+
+    books = []
+    seen = set()
+    for round_books in zip_longest(*results):
+        for book in round_books:
+            if book is None or book["link"] in seen:
+                continue
+            seen.add(book["link"])
+            books.append(book)
+
+    return books[:limit]
+
+
 # 抓取書籍的API
 @app.route("/get_book_recommendations", methods=["POST"])
 def get_book_recommendations():
@@ -562,8 +2317,8 @@ def get_book_recommendations():
     keywords = extract_keywords_from_message(user_message)
     print(f"提取的關鍵詞: {keywords}")
 
-    # 搜索相關書籍
-    books = search_books_google(keywords)
+    # 搜索相關書籍（每個關鍵字先查快取）
+    books = search_books_for_keywords(keywords)
 
     return jsonify({"books": books, "keywords": keywords})
 
@@ -581,61 +2336,88 @@ def teacher_dashboard():
     return render_template("teacher_analytics.html", username=session["username"])
 
 
-# 教師分析API
+# 教師分析API（以資料版本快取整份結果，並支援 ETag / If-None-Match）
 @app.route("/teacher_analytics")
 def teacher_analytics():
     if "username" not in session or session["username"] != "teacher":
         return jsonify({"error": "無權限"}), 403
 
     try:
-        conn = sqlite3.connect(DB_NAME)
+        conn = get_db()
         c = conn.cursor()
 
-        # 活躍學生數、平均理解、熱門單元、對話次數
-        stats = get_basic_stats(c)
+        # 每日活動統計（window: 7 / 30 / 90 / semester），不認得的值視為 7 天
+        window = request.args.get("window", "7")
+        if window not in ACTIVITY_WINDOWS and window != "semester":
+            window = "7"
 
-        # 鷹架類型統計
-        scaffolding_stats = get_scaffolding_stats(c)
+        # 「活躍學生」與每日活動都跟現在時間有關，快取只在同一個小時內有效
+        hour = datetime.now().strftime("%Y-%m-%d %H")
+        version = get_data_version(c)
 
-        # 學習單元統計
-        unit_stats = get_unit_stats(c)
+        with dashboard_cache_lock:
+            cached = dashboard_cache.get(window)
+        if cached and cached[:2] == (version, hour):
+            etag, payload = cached[2:]
+        else:
+            payload = json.dumps(
+                build_teacher_analytics(c, window), ensure_ascii=False
+            ).encode("utf-8")
+            etag = hashlib.sha256(payload).hexdigest()
+            with dashboard_cache_lock:
+                dashboard_cache[window] = (version, hour, etag, payload)
+
+        response = app.response_class(payload, mimetype="application/json")
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response.make_conditional(request)
 
-        # 理解程度統計
-        level_stats = get_level_stats(c)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-        # 每日活動統計
-        daily_activity = get_daily_activity(c)
 
+def build_teacher_analytics(cursor, window):
+    """計算教師儀表板的完整資料"""
+    return {
+        # 活躍學生數、平均理解、熱門單元、對話次數
+        "stats": get_basic_stats(cursor),
+        # 鷹架類型統計
+        "scaffolding_stats": get_scaffolding_stats(cursor),
+        # 學習單元統計
+        "unit_stats": get_unit_stats(cursor),
+        # 理解程度統計
+        "level_stats": get_level_stats(cursor),
+        # 每日活動統計
+        "daily_activity": get_daily_activity(cursor, window),
         # 每個學生的 總對話次數、鷹架、理解程度、最常討論單元、上次登入時間
-        students = get_student_details(c)
+        "students": get_student_details(cursor),
+    }
 
-        conn.close()
 
-        return jsonify(
-            {
-                "stats": stats,
-                "scaffolding_stats": scaffolding_stats,
-                "unit_stats": unit_stats,
-                "level_stats": level_stats,
-                "daily_activity": daily_activity,
-                "students": students,
-            }
-        )
+# 資料版本：/chat 寫入與 /chat/clear 時遞增，存在資料庫中讓所有 worker 共用
+def get_data_version(cursor):
+    cursor.execute("SELECT value FROM app_state WHERE key = 'data_version'")
+    row = cursor.fetchone()
+    return row[0] if row else 0
 
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+
+def bump_data_version(cursor):
+    """遞增資料版本（需與資料異動在同一個交易中）"""
+    cursor.execute(
+        "UPDATE app_state SET value = value + 1 WHERE key = 'data_version'"
+    )
 
 
 # 獲取學生相關資料
 def get_basic_stats(cursor):
-    """獲取基本統計數據"""
+    """獲取基本統計數據（讀取 student_summary / student_counts）"""
     # 活躍學生數（過去7天）
     week_ago = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d %H:%M:%S")
     cursor.execute(
         """
-        SELECT COUNT(DISTINCT username) 
-        FROM conversations 
-        WHERE username != 'teacher' AND timestamp > ?
+        SELECT COUNT(*) 
+        FROM student_summary 
+        WHERE username != 'teacher' AND last_activity > ?
     """,
         (week_ago,),
     )
@@ -643,34 +2425,30 @@ def get_basic_stats(cursor):
     active_students = cursor.fetchone()[0]
 
     # 總對話次數
-    cursor.execute("SELECT COUNT(*) FROM conversations WHERE username != 'teacher'")
+    cursor.execute(
+        "SELECT COALESCE(SUM(total_conversations), 0) FROM student_summary WHERE username != 'teacher'"
+    )
     total_conversations = cursor.fetchone()[0]
 
     # 最熱門的學習單元 挑出數量最多的學習單元
-    cursor.execute(
-        """
-        SELECT learning_unit, COUNT(*) as count 
-        FROM conversations 
-        WHERE username != 'teacher' AND learning_unit IS NOT NULL 
-        GROUP BY learning_unit 
-        ORDER BY count DESC 
-        LIMIT 1
-    """
-    )
-    popular_result = cursor.fetchone()
-    popular_unit = popular_result[0] if popular_result else "無"
+    unit_stats = get_unit_stats(cursor)
+    popular_unit = next(iter(unit_stats), "無")
 
-    # 平均理解程度
-    level_mapping = {"初學者": 1, "進階學習者": 2, "熟練者": 3}
+    # 平均理解程度（初學者=1、進階學習者=2、熟練者=3，其他=0），直接在 SQL 中計算
     cursor.execute(
         """
-        SELECT understanding_level 
-        FROM conversations 
-        WHERE username != 'teacher' AND understanding_level IS NOT NULL
+        SELECT CAST(SUM(count * CASE value
+                                    WHEN '初學者' THEN 1
+                                    WHEN '進階學習者' THEN 2
+                                    WHEN '熟練者' THEN 3
+                                    ELSE 0
+                                END) AS REAL) / SUM(count)
+        FROM student_counts 
+        WHERE username != 'teacher' AND dimension = 'level'
     """
     )
-    levels = [level_mapping.get(row[0], 0) for row in cursor.fetchall()]
-    avg_level = round(sum(levels) / len(levels), 1) if levels else 0
+    avg_result = cursor.fetchone()[0]
+    avg_level = round(avg_result, 1) if avg_result is not None else 0
 
     return {
         "activeStudents": active_students,
@@ -680,188 +2458,313 @@ def get_basic_stats(cursor):
     }
 
 
-def get_scaffolding_stats(cursor):
-    """獲取鷹架類型統計"""
+def _summary_counts(cursor, dimension):
+    """彙總所有學生在某個維度（scaffolding / unit / level）的次數，依次數由多到少"""
     cursor.execute(
         """
-        SELECT scaffolding_type, COUNT(*) as count 
-        FROM conversations 
-        WHERE username != 'teacher' AND scaffolding_type IS NOT NULL 
-        GROUP BY scaffolding_type
-    """
+        SELECT value, SUM(count) AS total 
+        FROM student_counts 
+        WHERE username != 'teacher' AND dimension = ? 
+        GROUP BY value 
+        ORDER BY total DESC, value
+    """,
+        (dimension,),
     )
     return dict(cursor.fetchall())
 
 
+def get_scaffolding_stats(cursor):
+    """獲取鷹架類型統計"""
+    return _summary_counts(cursor, "scaffolding")
+
+
 def get_unit_stats(cursor):
     """獲取學習單元統計"""
+    return _summary_counts(cursor, "unit")
+
+
+def get_level_stats(cursor):
+    """獲取理解程度統計"""
+    return _summary_counts(cursor, "level")
+
+
+def get_semester_start(today):
+    """本學期開學日：有設定 SEMESTER_START 就用設定值，否則以 2/1、8/1 為分界"""
+    if SEMESTER_START:
+        return datetime.strptime(SEMESTER_START, "%Y-%m-%d").date()
+    if today.month >= 8:
+        return today.replace(month=8, day=1)
+    if today.month >= 2:
+        return today.replace(month=2, day=1)
+    return today.replace(year=today.year - 1, month=8, day=1)
+
+
+def resolve_activity_window(window):
+    """把 window 參數（7 / 30 / 90 / semester）換成 (起始日期, 天數)"""
+    today = datetime.now().date()
+    if window == "semester":
+        start = min(get_semester_start(today), today)
+    else:
+        start = today - timedelta(days=ACTIVITY_WINDOWS.get(window, 7) - 1)
+    return start, (today - start).days + 1
+
+
+def get_daily_activity(cursor, window="7"):
+    """獲取每日活動統計（預設過去7天），讀取 daily_activity 彙總表，一次範圍查詢"""
+    start, days = resolve_activity_window(window)
+
     cursor.execute(
         """
-        SELECT learning_unit, COUNT(*) as count 
-        FROM conversations 
-        WHERE username != 'teacher' AND learning_unit IS NOT NULL 
-        GROUP BY learning_unit 
-        ORDER BY count DESC
-    """
+        SELECT day, SUM(count) 
+        FROM daily_activity 
+        WHERE day >= ? 
+        GROUP BY day
+    """,
+        (start.isoformat(),),
     )
-    return dict(cursor.fetchall())
+    counts = dict(cursor.fetchall())
+
+    # 最舊的日期在前面，沒有活動的日子補 0
+    daily_stats = {}
+    for i in range(days):
+        date = start + timedelta(days=i)
+        daily_stats[date.strftime("%m/%d")] = counts.get(
+            date.isoformat(), 0
+        )  # daily_stats[9/15] = 4 => 9/15 有 4次對話
 
+    return daily_stats
 
-def get_level_stats(cursor):
-    """獲取理解程度統計"""
+
+def get_student_details(cursor):
+    """獲取學生詳細資料（讀取 student_summary，成本只和學生人數有關）"""
     cursor.execute(
         """
-        SELECT understanding_level, COUNT(*) as count 
-        FROM conversations 
-        WHERE username != 'teacher' AND understanding_level IS NOT NULL 
-        GROUP BY understanding_level
+        WITH ranked AS (
+            SELECT username, dimension, value,
+                   ROW_NUMBER() OVER (
+                       PARTITION BY username, dimension ORDER BY count DESC, value
+                   ) AS rn
+            FROM student_counts
+            WHERE username != 'teacher' AND dimension IN ('scaffolding', 'unit')
+        )
+        SELECT s.username, s.total_conversations, sc.value,
+               s.latest_level, u.value, s.last_activity
+        FROM student_summary s
+        LEFT JOIN ranked sc
+               ON sc.username = s.username AND sc.dimension = 'scaffolding' AND sc.rn = 1
+        LEFT JOIN ranked u
+               ON u.username = s.username AND u.dimension = 'unit' AND u.rn = 1
+        WHERE s.username != 'teacher'
+        ORDER BY s.total_conversations DESC, s.username
     """
     )
-    return dict(cursor.fetchall())
 
+    return [
+        {
+            "username": username,
+            "total_conversations": total_conversations,
+            "main_scaffolding": main_scaffolding or "未知",
+            "current_level": current_level or "未知",
+            "favorite_unit": favorite_unit or "無",
+            "last_activity": last_activity,
+        }
+        for (
+            username,
+            total_conversations,
+            main_scaffolding,
+            current_level,
+            favorite_unit,
+            last_activity,
+        ) in cursor.fetchall()
+    ]
+
+
+# 學生摘要表：/chat 寫入對話時在同一個交易中更新，教師儀表板只讀這兩張表
+# student_summary: 每位學生的總對話數、最新理解程度、最後活動時間
+# student_counts:  每位學生在各鷹架類型 / 單元 / 理解程度的次數
+SUMMARY_TOTALS_SQL = """
+    SELECT username, COUNT(*), MAX(timestamp),
+           (SELECT understanding_level FROM conversations latest
+            WHERE latest.username = c.username AND latest.understanding_level IS NOT NULL
+            ORDER BY latest.timestamp DESC, latest.id DESC LIMIT 1)
+    FROM conversations c
+    GROUP BY username
+"""
+
+SUMMARY_COUNTS_SQL = """
+    SELECT username, 'scaffolding', scaffolding_type, COUNT(*) FROM conversations
+    WHERE scaffolding_type IS NOT NULL GROUP BY username, scaffolding_type
+    UNION ALL
+    SELECT username, 'unit', learning_unit, COUNT(*) FROM conversations
+    WHERE learning_unit IS NOT NULL GROUP BY username, learning_unit
+    UNION ALL
+    SELECT username, 'level', understanding_level, COUNT(*) FROM conversations
+    WHERE understanding_level IS NOT NULL GROUP BY username, understanding_level
+"""
+
+
+def update_student_summary(
+    cursor,
+    conversation_id,
+    username,
+    learning_unit,
+    scaffolding_type,
+    understanding_level,
+):
+    """新增一筆對話後更新摘要表（需與 INSERT 在同一個交易中）"""
+    cursor.execute(
+        """
+        INSERT INTO student_summary (username, total_conversations, latest_level, last_activity)
+        VALUES (?, 1, ?, (SELECT timestamp FROM conversations WHERE id = ?))
+        ON CONFLICT(username) DO UPDATE SET
+            total_conversations = total_conversations + 1,
+            latest_level = COALESCE(excluded.latest_level, latest_level),
+            last_activity = MAX(COALESCE(last_activity, ''), excluded.last_activity)
+    """,
+        (username, understanding_level, conversation_id),
+    )
+
+    for dimension, value in (
+        ("scaffolding", scaffolding_type),
+        ("unit", learning_unit),
+        ("level", understanding_level),
+    ):
+        if value is None:
+            continue
+        cursor.execute(
+            """
+            INSERT INTO student_counts (username, dimension, value, count)
+            VALUES (?, ?, ?, 1)
+            ON CONFLICT(username, dimension, value) DO UPDATE SET count = count + 1
+        """,
+            (username, dimension, value),
+        )
+
+
+def update_daily_activity(
+    cursor, conversation_id, username, learning_unit, scaffolding_type
+):
+    """新增一筆對話後累加當日彙總（教師帳號的對話不列入）"""
+    if username == "teacher":
+        return
+    cursor.execute(
+        """
+        INSERT INTO daily_activity (day, learning_unit, scaffolding_type, count)
+        VALUES ((SELECT DATE(timestamp) FROM conversations WHERE id = ?), ?, ?, 1)
+        ON CONFLICT(day, learning_unit, scaffolding_type) DO UPDATE SET count = count + 1
+    """,
+        (conversation_id, learning_unit or "", scaffolding_type or ""),
+    )
 
-def get_daily_activity(cursor):
-    """獲取每日活動統計（過去7天）"""
-    daily_stats = {}
-    for i in range(7):
-        date = datetime.now() - timedelta(days=i)
-        date_str = date.strftime("%Y-%m-%d")
 
-        cursor.execute(
-            """
-            SELECT COUNT(*) 
-            FROM conversations 
-            WHERE username != 'teacher' 
-            AND DATE(timestamp) = ?
-        """,
-            (date_str,),
-        )
+DAILY_ACTIVITY_SQL = """
+    SELECT DATE(timestamp), COALESCE(learning_unit, ''), COALESCE(scaffolding_type, ''), COUNT(*)
+    FROM conversations
+    WHERE username != 'teacher'
+    GROUP BY 1, 2, 3
+"""
 
-        count = cursor.fetchone()[0]
-        daily_stats[date.strftime("%m/%d")] = (
-            count  # daily_stats[9/15] = 4 => 9/15 有 4個人
-        )
 
-    # 反轉順序，讓最舊的日期在前面
-    return dict(reversed(list(daily_stats.items())))
+def rebuild_daily_activity(cursor):
+    """由 conversations 重新計算每日彙總表"""
+    cursor.execute("DELETE FROM daily_activity")
+    cursor.execute(
+        "INSERT INTO daily_activity (day, learning_unit, scaffolding_type, count) "
+        + DAILY_ACTIVITY_SQL
+    )
 
 
-def get_student_details(cursor):
-    """獲取學生詳細資料"""
+def rebuild_student_summary(cursor):
+    """由 conversations 重新計算整張摘要表"""
+    cursor.execute("DELETE FROM student_summary")
+    cursor.execute("DELETE FROM student_counts")
+    cursor.execute(
+        "INSERT INTO student_summary (username, total_conversations, last_activity, latest_level) "
+        + SUMMARY_TOTALS_SQL
+    )
     cursor.execute(
-        "SELECT DISTINCT username FROM conversations WHERE username != 'teacher'"
+        "INSERT INTO student_counts (username, dimension, value, count) "
+        + SUMMARY_COUNTS_SQL
     )
-    usernames = [row[0] for row in cursor.fetchall()]
 
-    students = []
 
-    # 把每個學生抓出來，看他的資訊
-    for username in usernames:
-        # 總對話次數
-        cursor.execute(
-            "SELECT COUNT(*) FROM conversations WHERE username = ?", (username,)
-        )
-        total_conversations = cursor.fetchone()[0]
+def verify_student_summary(cursor):
+    """比對摘要表、每日彙總表與 conversations 重新計算的結果，回傳不一致的筆數"""
+    cursor.execute(SUMMARY_TOTALS_SQL)
+    expected_totals = set(cursor.fetchall())
+    cursor.execute(
+        "SELECT username, total_conversations, last_activity, latest_level FROM student_summary"
+    )
+    actual_totals = set(cursor.fetchall())
 
-        # 主要鷹架類型
-        cursor.execute(
-            """
-            SELECT scaffolding_type, COUNT(*) as count 
-            FROM conversations 
-            WHERE username = ? AND scaffolding_type IS NOT NULL 
-            GROUP BY scaffolding_type 
-            ORDER BY count DESC 
-            LIMIT 1
-        """,
-            (username,),
-        )
-        main_scaffolding_result = cursor.fetchone()
-        main_scaffolding = (
-            main_scaffolding_result[0] if main_scaffolding_result else "未知"
-        )
+    cursor.execute(SUMMARY_COUNTS_SQL)
+    expected_counts = set(cursor.fetchall())
+    cursor.execute("SELECT username, dimension, value, count FROM student_counts")
+    actual_counts = set(cursor.fetchall())
 
-        # 當前理解程度（最新的）
-        cursor.execute(
-            """
-            SELECT understanding_level 
-            FROM conversations 
-            WHERE username = ? AND understanding_level IS NOT NULL 
-            ORDER BY timestamp DESC 
-            LIMIT 1
-        """,
-            (username,),
-        )
-        current_level_result = cursor.fetchone()
-        current_level = current_level_result[0] if current_level_result else "未知"
+    cursor.execute(DAILY_ACTIVITY_SQL)
+    expected_daily = set(cursor.fetchall())
+    cursor.execute(
+        "SELECT day, learning_unit, scaffolding_type, count FROM daily_activity"
+    )
+    actual_daily = set(cursor.fetchall())
 
-        # 最常討論的單元
-        cursor.execute(
-            """
-            SELECT learning_unit, COUNT(*) as count 
-            FROM conversations 
-            WHERE username = ? AND learning_unit IS NOT NULL 
-            GROUP BY learning_unit 
-            ORDER BY count DESC 
-            LIMIT 1
-        """,
-            (username,),
-        )
-        favorite_unit_result = cursor.fetchone()
-        favorite_unit = favorite_unit_result[0] if favorite_unit_result else "無"
+    return (
+        len(expected_totals ^ actual_totals)
+        + len(expected_counts ^ actual_counts)
+        + len(expected_daily ^ actual_daily)
+    )
 
-        # 最後活動時間
-        cursor.execute(
-            """
-            SELECT MAX(timestamp) 
-            FROM conversations 
-            WHERE username = ?
-        """,
-            (username,),
-        )
-        last_activity = cursor.fetchone()[0]
 
-        students.append(
-            {
-                "username": username,
-                "total_conversations": total_conversations,
-                "main_scaffolding": main_scaffolding,
-                "current_level": current_level,
-                "favorite_unit": favorite_unit,
-                "last_activity": last_activity,
-            }
-        )
+# 重建學生摘要表與每日彙總表：flask --app app rebuild-summary [--verify-only]
+@app.cli.command("rebuild-summary")
+@click.option("--verify-only", is_flag=True, help="只檢查一致性，不重建")
+def rebuild_summary_command(verify_only):
+    with db_connection() as conn:
+        c = conn.cursor()
+        if not verify_only:
+            rebuild_student_summary(c)
+            rebuild_daily_activity(c)
+            bump_data_version(c)
+            conn.commit()
+            print("已由 conversations 重建學生摘要表")
 
-    # 按總對話次數排序
-    students.sort(key=lambda x: x["total_conversations"], reverse=True)
-    return students
+        mismatches = verify_student_summary(c)
+        if mismatches:
+            print(f"學生摘要表與 conversations 不一致：{mismatches} 筆")
+            sys.exit(1)
+        print("學生摘要表與 conversations 一致")
 
 
 def get_user_learning_history(username):
-    """獲取使用者的學習歷史記錄"""
-    conn = sqlite3.connect(DB_NAME)
+    """獲取使用者的學習歷史記錄（最近的在前），活躍學生直接由快取取得"""
+    return history_cache.get(username, load_user_learning_history)
+
+
+def load_user_learning_history(username):
+    """從資料庫讀取使用者最近的學習歷史記錄（已清除的對話只保留單元與鷹架等資訊）"""
+    conn = get_db()
     c = conn.cursor()
+    watermark = get_clear_watermark(c, username)
     c.execute(
         """
-        SELECT user_message, learning_unit, scaffolding_type, understanding_level 
+        SELECT CASE WHEN id < ? THEN ? ELSE user_message END, 
+               learning_unit, scaffolding_type, understanding_level 
         FROM conversations 
         WHERE username = ? 
         ORDER BY timestamp DESC 
-        LIMIT 10
+        LIMIT ?
     """,
-        (username,),
+        (watermark, CLEARED_MESSAGE, username, USER_HISTORY_LIMIT),
     )
 
     history = c.fetchall()
-    conn.close()
 
     return history
 
 
 import json
 import re
-from openai import OpenAI
-
-client = OpenAI()
 
 
 def normalize_scaffolding_type(scaffolding_type):
@@ -973,31 +2876,14 @@ def analyze_scaffolding_need(user_message, learning_unit, user_history, username
         return "差異鷹架", understanding_level, "分析時發生錯誤。"
 
 
+@llm_call_site("scaffolding_analysis")
 def analyze_scaffolding_need(user_message, learning_unit, user_history, username):
     """
     改良版：以量化平均方式判斷理解層級，GPT 主導鷹架判斷。
     """
 
     # === Step 1: 根據歷史紀錄量化理解層級 ===
-    level_score_map = {"初學者": 1, "進階學習者": 2, "熟練者": 3}
-
-    # 過濾掉未知紀錄，換算成分數
-    valid_scores = [
-        level_score_map[h[3]] for h in user_history if h[3] in level_score_map
-    ]
-
-    if valid_scores:
-        avg_score = sum(valid_scores) / len(valid_scores)
-    else:
-        avg_score = 1  # 若沒有紀錄，預設初學者
-
-    # 根據平均分數決定目前理解層級
-    if avg_score < 1.5:
-        understanding_level = "初學者"
-    elif avg_score < 2.5:
-        understanding_level = "進階學習者"
-    else:
-        understanding_level = "熟練者"
+    understanding_level = estimate_understanding_level(user_history)
 
     # === Step 2: 讓 GPT 主導判斷鷹架類型 ===
     refinement_prompt = f"""
@@ -1069,6 +2955,7 @@ def analyze_scaffolding_need(user_message, learning_unit, user_history, username
 
             return scaffolding_type, data["understanding_level"], data["reason"]
         else:
+            mark_llm_parse_failure()
             return (
                 "差異鷹架",
                 understanding_level,
@@ -1076,10 +2963,408 @@ def analyze_scaffolding_need(user_message, learning_unit, user_history, username
             )
 
     except Exception as e:
+        # GPT 呼叫成功但 JSON 或欄位有誤時記為解析失敗
+        mark_llm_parse_failure()
         print(f"鷹架分析錯誤: {e}")
         return "差異鷹架", understanding_level, "分析時發生錯誤。"
 
 
+def estimate_understanding_level(user_history):
+    """以歷史紀錄的平均分數估計目前理解層級"""
+    level_score_map = {"初學者": 1, "進階學習者": 2, "熟練者": 3}
+
+    # 過濾掉未知紀錄，換算成分數
+    valid_scores = [
+        level_score_map[h[3]] for h in user_history if h[3] in level_score_map
+    ]
+
+    if valid_scores:
+        avg_score = sum(valid_scores) / len(valid_scores)
+    else:
+        avg_score = 1  # 若沒有紀錄，預設初學者
+
+    # 根據平均分數決定目前理解層級
+    if avg_score < 1.5:
+        return "初學者"
+    elif avg_score < 2.5:
+        return "進階學習者"
+    else:
+        return "熟練者"
+
+
+@llm_call_site("fused_analysis")
+def analyze_and_respond(user_message, learning_unit, user_history, username):
+    """
+    合併模式：一次 GPT 呼叫同時回傳鷹架判斷與鷹架回覆。
+    解析失敗時回傳 None，由呼叫端改走兩段式流程。
+    """
+    understanding_level = estimate_understanding_level(user_history)
+
+    # 三種鷹架的教學指引都附上，讓 GPT 依判斷結果套用對應的那一份
+    guides = "\n".join(
+        f"【{scaffolding_type}】{build_scaffolding_prompt(user_message, learning_unit, scaffolding_type, understanding_level)}"
+        for scaffolding_type in ("差異鷹架", "重複鷹架", "協同鷹架")
+    )
+
+    fused_prompt = f"""
+你是一位機器學習導師，請在一次回覆中完成兩件事：
+1. 根據鷹架理論判斷此學生目前最需要的鷹架類型
+2. 依照該鷹架類型的教學指引回答學生的提問
+
+鷹架理論定義如下：
+- 差異鷹架：當學生對相同主題理解程度不一，或學習風格不同時，提供不同角度、難度與範例引導。
+- 重複鷹架：當學生針對特定主題需要鞏固理解，提供多元說明方式或多種做法，協助反覆練習。
+- 協同鷹架：當學生處理需要整合多項知識與技能的高層次任務，協助整合概念與策略。
+
+學生目前理解層級：{understanding_level}
+學習單元：{learning_unit}
+學生提問：{user_message}
+
+歷史紀錄摘要：
+{[f"問題：{h[0]}，單元：{h[1]}，理解：{h[3]}" for h in user_history[-5:]]}
+
+各鷹架類型的教學指引：
+{guides}
+
+**重要：scaffolding_type 必須只能是以下三個值之一（不可加「性」字）：**
+- 差異鷹架
+- 重複鷹架
+- 協同鷹架
+
+回傳 JSON 格式（不要任何 markdown 語法），reply 為依所選鷹架指引撰寫的回答：
+{{
+    "scaffolding_type": "差異鷹架",
+    "understanding_level": "初學者",
+    "reason": "簡短說明",
+    "reply": "給學生的回答"
+}}
+"""
+
+    try:
+        response = client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {
+                    "role": "system",
+                    "content": "你是機器學習導師兼教育心理學助理。回覆必須是純 JSON，不要使用 markdown。鷹架類型只能是：差異鷹架、重複鷹架、協同鷹架（不可加性字）。",
+                },
+                {"role": "user", "content": fused_prompt},
+            ],
+            max_tokens=600,
+            temperature=0.3,
+        )
+
+        text = response.choices[0].message.content.strip()
+        text = text.replace("```json", "").replace("```", "").strip()
+
+        match = re.search(r"\{.*\}", text, re.DOTALL)
+        if not match:
+            mark_llm_parse_failure()
+            print(f"合併模式無法解析 GPT 回覆: {text}")
+            return None
+
+        data = json.loads(match.group(0))
+        raw_reply = data.get("reply")
+        if not isinstance(raw_reply, str) or not raw_reply.strip():
+            mark_llm_parse_failure()
+            print(f"合併模式缺少回覆內容: {text}")
+            return None
+
+        scaffolding_type = normalize_scaffolding_type(data.get("scaffolding_type"))
+        understanding_level = data.get("understanding_level", understanding_level)
+        reason = data.get("reason", "標準鷹架分析")
+        reply = format_code_blocks(_postprocess_complete_sentences(raw_reply))
+
+        return scaffolding_type, understanding_level, reason, reply
+
+    except Exception as e:
+        mark_llm_parse_failure()
+        print(f"合併模式錯誤: {e}")
+        return None
+
+
+def predict_scaffolding_type(user_history):
+    """以最近紀錄中最常出現的鷹架類型作為預測（同數量時取較新的）"""
+    counter = Counter(normalize_scaffolding_type(h[2]) for h in user_history if h[2])
+    return counter.most_common(1)[0][0] if counter else "差異鷹架"
+
+
+def _timed_call(func, *args):
+    """執行 func 並回傳 (結果, 耗時毫秒)"""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def speculative_scaffolding_pipeline(
+    user_message, learning_unit, user_history, username
+):
+    """
+    推測模式：分析鷹架需求的同時，先用預測的鷹架類型產生回覆。
+    預測與分析結果相同就直接採用，不同才重新產生。
+    """
+    predicted_type = predict_scaffolding_type(user_history)
+    predicted_level = estimate_understanding_level(user_history)
+
+    speculative = speculation_executor.submit(
+        _timed_call,
+        generate_scaffolded_response,
+        user_message,
+        learning_unit,
+        predicted_type,
+        predicted_level,
+        username,
+    )
+
+    (scaffolding_type, understanding_level, analysis_reason), analysis_ms = (
+        _timed_call(
+            analyze_scaffolding_need,
+            user_message,
+            learning_unit,
+            user_history,
+            username,
+        )
+    )
+    scaffolding_type = normalize_scaffolding_type(scaffolding_type)
+
+    hit = (scaffolding_type, understanding_level) == (predicted_type, predicted_level)
+    if hit:
+        reply, generate_ms = speculative.result()
+        # 串行時需要 analysis + generate，重疊後只需要兩者較長者
+        saved_ms = min(analysis_ms, generate_ms)
+    else:
+        reply = generate_scaffolded_response(
+            user_message, learning_unit, scaffolding_type, understanding_level, username
+        )
+        saved_ms = 0
+
+    with speculation_lock:
+        speculation_stats["hits" if hit else "misses"] += 1
+        speculation_stats["saved_ms"] += saved_ms
+
+    return scaffolding_type, understanding_level, analysis_reason, reply
+
+
+def get_speculation_stats():
+    """推測模式的命中率與節省時間"""
+    with speculation_lock:
+        stats = dict(speculation_stats)
+    total = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / total, 3) if total else 0
+    stats["saved_ms"] = round(stats["saved_ms"], 1)
+    stats["avg_saved_ms"] = round(stats["saved_ms"] / total, 1) if total else 0
+    return stats
+
+
+# 推測模式統計（教師可查看）
+@app.route("/admin/speculation_stats")
+def speculation_stats_api():
+    if "username" not in session or session["username"] != "teacher":
+        return jsonify({"error": "無權限"}), 403
+    return jsonify(get_speculation_stats())
+
+
+# LLM 客戶端狀態（呼叫、重試、失敗次數與斷路器狀態）
+@app.route("/admin/llm_status")
+def llm_status_api():
+    if "username" not in session or session["username"] != "teacher":
+        return jsonify({"error": "無權限"}), 403
+    return jsonify(client.stats())
+
+
+def render_metrics():
+    """Prometheus 文字格式的監控指標"""
+    lines = []
+    for metric in (
+        http_request_duration,
+        chat_stage_duration,
+        sqlite_query_duration,
+        sqlite_slow_queries,
+    ):
+        lines.extend(metric.render())
+
+    def gauge(name, help_text, value, metric_type="gauge"):
+        lines.extend(
+            [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}", f"{name} {value}"]
+        )
+
+    llm = client.stats()
+    for key in ("calls", "retries", "failures", "short_circuited", "breaker_opened"):
+        gauge(f"llm_client_{key}_total", f"LLM 客戶端 {key} 次數", llm.get(key, 0), "counter")
+    lines.extend(["# HELP llm_breaker_state 斷路器目前狀態", "# TYPE llm_breaker_state gauge"])
+    for state in ("closed", "open", "half_open"):
+        lines.append(f'llm_breaker_state{{state="{state}"}} {int(llm["state"] == state)}')
+    gauge("llm_calls_recorded_total", "已寫入 llm_calls 的筆數", llm_call_recorder.written, "counter")
+    gauge("llm_calls_dropped_total", "緩衝區滿而丟棄的 llm_calls 筆數", llm_call_recorder.dropped, "counter")
+
+    cache = response_cache.stats()
+    gauge("response_cache_hits_total", "回覆快取命中次數", cache["hits"], "counter")
+    gauge("response_cache_misses_total", "回覆快取未命中次數", cache["misses"], "counter")
+    gauge("response_cache_size", "回覆快取目前筆數", cache["size"])
+
+    history = history_cache.stats()
+    gauge("history_cache_hits_total", "學習歷史快取命中次數", history["hits"], "counter")
+    gauge("history_cache_misses_total", "學習歷史快取未命中次數", history["misses"], "counter")
+    gauge("history_cache_evictions_total", "學習歷史快取淘汰次數", history["evictions"], "counter")
+    gauge("history_cache_bytes", "學習歷史快取估計大小", history["bytes"])
+    return "\n".join(lines) + "\n"
+
+
+# 記錄每個請求的處理時間；以路由樣板（而非實際網址）分組，避免標籤數量失控
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_duration(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        http_request_duration.observe(
+            (route, request.method, str(response.status_code)),
+            time.perf_counter() - started,
+        )
+    return response
+
+
+# Prometheus 抓取端點
+@app.route("/metrics")
+def metrics():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return jsonify({"error": "無權限"}), 403
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+# 最近的慢查詢（教師可查看），新的在前
+@app.route("/admin/slow_queries")
+def slow_queries_api():
+    if "username" not in session or session["username"] != "teacher":
+        return jsonify({"error": "無權限"}), 403
+    return jsonify(
+        {"threshold_ms": SQLITE_SLOW_QUERY_MS, "queries": list(reversed(slow_query_log))}
+    )
+
+
+# LLM 用量統計的分組方式
+LLM_USAGE_GROUPS = {
+    "call_site": "call_site",
+    "day": "date(created_at)",
+    "student": "COALESCE(username, '')",
+    "model": "COALESCE(model, '')",
+}
+
+LLM_USAGE_SQL = """
+    WITH ranked AS (
+        SELECT {group} AS grp, latency_ms, prompt_tokens, completion_tokens, outcome,
+               ROW_NUMBER() OVER (PARTITION BY {group} ORDER BY latency_ms) AS rn,
+               COUNT(*) OVER (PARTITION BY {group}) AS n
+        FROM llm_calls
+        WHERE created_at >= datetime('now', ?) AND (? IS NULL OR call_site = ?)
+    )
+    SELECT grp, COUNT(*),
+           MIN(CASE WHEN rn >= 0.50 * n THEN latency_ms END),
+           MIN(CASE WHEN rn >= 0.95 * n THEN latency_ms END),
+           MIN(CASE WHEN rn >= 0.99 * n THEN latency_ms END),
+           COALESCE(SUM(prompt_tokens), 0),
+           COALESCE(SUM(completion_tokens), 0),
+           SUM(outcome = 'parse_fail'),
+           SUM(outcome = 'error')
+    FROM ranked
+    GROUP BY grp
+    ORDER BY SUM(COALESCE(prompt_tokens, 0) + COALESCE(completion_tokens, 0)) DESC, grp
+"""
+
+
+def get_llm_usage(cursor, group, days, call_site=None):
+    """依分組統計 LLM 呼叫次數、延遲百分位數（nearest-rank）、token 用量與失敗次數"""
+    cursor.execute(
+        LLM_USAGE_SQL.format(group=LLM_USAGE_GROUPS[group]),
+        (f"-{days} days", call_site, call_site),
+    )
+    rows = []
+    for grp, calls, p50, p95, p99, prompt, completion, parse_fail, errors in cursor.fetchall():
+        rows.append(
+            {
+                group: grp,
+                "calls": calls,
+                "latency_ms": {"p50": p50, "p95": p95, "p99": p99},
+                "prompt_tokens": prompt,
+                "completion_tokens": completion,
+                "avg_tokens": round((prompt + completion) / calls, 1),
+                "parse_fail": parse_fail,
+                "errors": errors,
+            }
+        )
+    return rows
+
+
+# LLM 用量（?group=call_site|day|student|model&days=7&call_site=...）
+@app.route("/admin/llm_usage")
+def llm_usage_api():
+    if "username" not in session or session["username"] != "teacher":
+        return jsonify({"error": "無權限"}), 403
+
+    group = request.args.get("group", "call_site")
+    if group not in LLM_USAGE_GROUPS:
+        return jsonify({"error": f"group 必須是 {', '.join(LLM_USAGE_GROUPS)} 之一"}), 400
+    days = request.args.get("days", 7, type=int)
+    call_site = request.args.get("call_site") or None
+
+    # 先寫入尚在佇列中的紀錄，讓統計包含最新的呼叫
+    llm_call_recorder.flush()
+
+    c = get_db().cursor()
+    return jsonify(
+        {
+            "group": group,
+            "days": days,
+            "call_site": call_site,
+            "rows": get_llm_usage(c, group, days, call_site),
+            "recorder": {
+                "written": llm_call_recorder.written,
+                "dropped": llm_call_recorder.dropped,
+            },
+        }
+    )
+
+
+def run_scaffolding_pipeline(user_message, learning_unit, user_history, username):
+    """依 CHAT_PIPELINE_MODE 產生 (鷹架類型, 理解程度, 分析理由, 回覆)"""
+    if CHAT_PIPELINE_MODE == "fused":
+        # 分析與回覆在同一次呼叫完成，無法再細分
+        with chat_stage("analyze_and_generate"):
+            result = analyze_and_respond(
+                user_message, learning_unit, user_history, username
+            )
+        if result is not None:
+            return result
+
+    if CHAT_PIPELINE_MODE == "speculative":
+        # 分析與產生回覆彼此重疊，只記錄整段時間
+        with chat_stage("analyze_and_generate"):
+            return speculative_scaffolding_pipeline(
+                user_message, learning_unit, user_history, username
+            )
+
+    # 兩段式流程：先分析鷹架需求，再產生回覆
+    with chat_stage("analyze"):
+        scaffolding_type, understanding_level, analysis_reason = (
+            analyze_scaffolding_need(
+                user_message, learning_unit, user_history, username
+            )
+        )
+
+    # 再次確保正確格式
+    scaffolding_type = normalize_scaffolding_type(scaffolding_type)
+
+    with chat_stage("generate"):
+        reply = generate_scaffolded_response(
+            user_message, learning_unit, scaffolding_type, understanding_level, username
+        )
+    return scaffolding_type, understanding_level, analysis_reason, reply
+
+
 ###########################################################################
 
 
@@ -1095,47 +3380,124 @@ def dashboard():
 ###########################################################################
 
 
-# 對話紀錄
+# 對話紀錄：以對話 id 為游標分頁，最新的一頁在前
+#   /chat/history?limit=20            最新 20 輪
+#   /chat/history?before=<id>         id 小於 before 的前一頁（往上捲動載入更早的對話）
+#   /chat/history?since=<id>          id 大於 since 的新對話（只取增量）
+# 回傳 {"messages": [...由舊到新...], "oldest_id", "latest_id", "has_more"}；
+# 分頁模式的 has_more 表示還有更早的對話，增量模式表示還有更新的對話（以 since=latest_id 繼續）
 @app.route("/chat/history")
 def chat_history():
     if "username" not in session:
         return jsonify({"error": "未登入"}), 401
 
     username = session["username"]
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute(
-        """
-        SELECT user_message, bot_reply, learning_unit, scaffolding_type, understanding_level 
-        FROM conversations 
-        WHERE username = ? 
-        ORDER BY timestamp ASC
-    """,
-        (username,),
+    limit = request.args.get("limit", CHAT_HISTORY_PAGE_SIZE, type=int)
+    before = request.args.get("before", type=int)
+    since = request.args.get("since", type=int)
+    if before is not None and since is not None:
+        return jsonify({"error": "before 與 since 不能同時使用"}), 400
+    limit = max(1, min(limit, CHAT_HISTORY_MAX_PAGE_SIZE))
+
+    return Response(
+        stream_with_context(_stream_chat_history(username, limit, before, since)),
+        mimetype="application/json",
     )
-    rows = c.fetchall()
-    conn.close()
 
-    history = []
-    for (
-        user_msg,
-        bot_reply,
-        learning_unit,
-        scaffolding_type,
-        understanding_level,
-    ) in rows:
-        history.append({"role": "user", "content": user_msg})
-        history.append(
-            {
-                "role": "ai",
-                "content": bot_reply,
-                "learning_unit": learning_unit,
-                "scaffolding_type": scaffolding_type,
-                "understanding_level": understanding_level,
-            }
+
+def _stream_chat_history(username, limit, before, since):
+    """以 fetchmany 逐批編碼 JSON，不必先把整份紀錄載入成 list"""
+    # 連線要在產生器裡取得：view 回傳時 Flask 就會執行 teardown_appcontext 歸還 g.db，
+    # 若沿用 view 裡借到的連線，串流期間它可能已被其他請求拿走或關閉
+    conn = get_db()
+    c = conn.cursor()
+    # 清除水位以前的對話不再顯示
+    watermark = get_clear_watermark(c, username)
+    if since is not None:
+        c.execute(
+            """
+            SELECT id, user_message, bot_reply, learning_unit, scaffolding_type, understanding_level 
+            FROM conversations 
+            WHERE username = ? AND id > ? AND id >= ? 
+            ORDER BY id ASC 
+            LIMIT ?
+        """,
+            (username, since, watermark, limit),
+        )
+    else:
+        c.execute(
+            """
+            SELECT * FROM (
+                SELECT id, user_message, bot_reply, learning_unit, scaffolding_type, understanding_level 
+                FROM conversations 
+                WHERE username = ? AND id < ? AND id >= ? 
+                ORDER BY id DESC 
+                LIMIT ?
+            ) ORDER BY id ASC
+        """,
+            (
+                username,
+                before if before is not None else sys.maxsize,
+                watermark,
+                limit,
+            ),
         )
 
-    return jsonify(history)
+    oldest_id = latest_id = None
+
+    yield '{"messages":['
+    separator = ""
+    while True:
+        rows = c.fetchmany(CHAT_HISTORY_FETCH_SIZE)
+        if not rows:
+            break
+        chunk = []
+        for conv_id, user_msg, bot_reply, unit, scaffolding, level in rows:
+            if oldest_id is None:
+                oldest_id = conv_id
+            latest_id = conv_id
+            chunk.append(
+                json.dumps(
+                    {"id": conv_id, "role": "user", "content": user_msg},
+                    ensure_ascii=False,
+                )
+            )
+            chunk.append(
+                json.dumps(
+                    {
+                        "id": conv_id,
+                        "role": "ai",
+                        "content": bot_reply,
+                        "learning_unit": unit,
+                        "scaffolding_type": scaffolding,
+                        "understanding_level": level,
+                    },
+                    ensure_ascii=False,
+                )
+            )
+        yield separator + ",".join(chunk)
+        separator = ","
+
+    # 這一頁之外是否還有對話（走 (username, id) 索引，只看一筆）
+    has_more = False
+    if oldest_id is not None:
+        if since is not None:
+            condition, boundary = "id > ?", latest_id
+        else:
+            condition, boundary = "id < ?", oldest_id
+        has_more = (
+            conn.execute(
+                "SELECT EXISTS (SELECT 1 FROM conversations "
+                f"WHERE username = ? AND id >= ? AND {condition})",
+                (username, watermark, boundary),
+            ).fetchone()[0]
+            == 1
+        )
+
+    trailer = json.dumps(
+        {"oldest_id": oldest_id, "latest_id": latest_id, "has_more": has_more}
+    )
+    yield "]," + trailer[1:]
 
 
 # 個人學習分析頁面
@@ -1155,27 +3517,28 @@ def my_learning_analytics():
     username = session["username"]
 
     try:
-        conn = sqlite3.connect(DB_NAME)
+        conn = get_db()
         c = conn.cursor()
 
-        # 獲取使用者所有對話記錄
+        # 獲取使用者所有對話記錄（已清除的對話內容以 CLEARED_MESSAGE 取代）
         c.execute(
             """
-            SELECT learning_unit, understanding_level, user_message, scaffolding_type, timestamp
+            SELECT learning_unit, understanding_level, 
+                   CASE WHEN id < ? THEN ? ELSE user_message END, scaffolding_type, timestamp
             FROM conversations 
             WHERE username = ? 
             ORDER BY timestamp DESC
         """,
-            (username,),
+            (get_clear_watermark(c, username), CLEARED_MESSAGE, username),
         )
         conversations = c.fetchall()
-        conn.close()
 
         if not conversations:
             return jsonify(
                 {
                     "unit_progress": {},
                     "weakness_analysis": {},
+                    "weakness_sources": {},
                     "overall_stats": {
                         "total_conversations": 0,
                         "units_studied": 0,
@@ -1191,7 +3554,9 @@ def my_learning_analytics():
         unit_progress = analyze_unit_progress(conversations)
 
         # 分析各單元的弱點
-        weakness_analysis = analyze_unit_weakness(conversations, username)
+        weakness_analysis, weakness_sources = analyze_unit_weakness(
+            conversations, username
+        )
 
         # 整體統計
         overall_stats = calculate_overall_stats(conversations)
@@ -1206,6 +3571,7 @@ def my_learning_analytics():
             {
                 "unit_progress": unit_progress,
                 "weakness_analysis": weakness_analysis,
+                "weakness_sources": weakness_sources,  # 各單元弱點分析是快取或重新分析
                 "overall_stats": overall_stats,
                 "scaffolding_stats": scaffolding_stats,  # 新增
                 "timeline": timeline,
@@ -1217,6 +3583,31 @@ def my_learning_analytics():
         return jsonify({"error": str(e)}), 500
 
 
+# 弱點分析背景工作進度，前端在有單元「分析中」時輪詢
+@app.route("/my_learning/weakness_status")
+def weakness_status():
+    if "username" not in session:
+        return jsonify({"error": "未登入"}), 401
+
+    conn = get_db()
+    c = conn.cursor()
+    c.execute(
+        """
+        SELECT json_extract(payload, '$.unit'), status, last_error 
+        FROM jobs 
+        WHERE owner = ? AND kind = 'unit_weakness' AND status IN ('queued', 'running') 
+        ORDER BY id
+    """,
+        (session["username"],),
+    )
+    pending = [
+        {"unit": unit, "status": status, "retrying": last_error is not None}
+        for unit, status, last_error in c.fetchall()
+    ]
+
+    return jsonify({"pending": pending, "done": not pending})
+
+
 def calculate_scaffolding_stats(conversations):
     """計算使用者的鷹架類型統計"""
     scaffolding_counter = Counter()
@@ -1334,11 +3725,10 @@ def analyze_unit_progress(conversations):
     return result
 
 
-def analyze_unit_weakness(conversations, username):
-    """使用 GPT 分析各單元的弱點"""
+def group_unit_conversations(conversations):
+    """按單元分組對話（排除通用概念），保持原本由新到舊的順序"""
     unit_conversations = {}
 
-    # 按單元分組對話
     for unit, level, message, scaffolding, timestamp in conversations:
         if not unit or unit == "通用概念":
             continue
@@ -1350,23 +3740,20 @@ def analyze_unit_weakness(conversations, username):
             {"message": message, "level": level, "scaffolding": scaffolding}
         )
 
-    weakness_result = {}
+    return unit_conversations
 
-    for unit, convs in unit_conversations.items():
-        # 只分析有足夠對話記錄的單元（至少3次對話）
-        if len(convs) < 3:
-            weakness_result[unit] = {
-                "weakness": "對話次數不足，尚無法分析弱點",
-                "suggestions": ["建議多與 AI 討論此單元的內容"],
-                "confidence": "低",
-            }
-            continue
 
-        # 取最近5次對話進行分析
-        recent_convs = convs[:5]
+@llm_call_site("weakness_analysis")
+def analyze_single_unit_weakness(unit, convs, username=None):
+    """
+    用 GPT 分析單一單元的弱點。
+    回傳 (分析結果, 是否可快取)；解析失敗或發生錯誤時不可快取，下次會重新分析。
+    """
+    # 取最近5次對話進行分析
+    recent_convs = convs[:5]
 
-        # 構建 GPT 分析提示
-        analysis_prompt = f"""
+    # 構建 GPT 分析提示
+    analysis_prompt = f"""
 你是一位機器學習教育專家。請根據學生在「{unit}」單元的學習記錄，分析其可能的弱點。
 
 學習記錄：
@@ -1385,45 +3772,240 @@ def analyze_unit_weakness(conversations, username):
 }}
 """
 
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "你是教育分析專家，專門分析學生的學習弱點。",
-                    },
-                    {"role": "user", "content": analysis_prompt},
-                ],
-                max_tokens=300,
-                temperature=0.3,
-            )
+    try:
+        response = client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {
+                    "role": "system",
+                    "content": "你是教育分析專家，專門分析學生的學習弱點。",
+                },
+                {"role": "user", "content": analysis_prompt},
+            ],
+            max_tokens=300,
+            temperature=0.3,
+        )
 
-            result_text = response.choices[0].message.content.strip()
+        result_text = response.choices[0].message.content.strip()
 
-            # 解析 JSON
-            import re
+        # 解析 JSON
+        match = re.search(r"\{.*\}", result_text, re.DOTALL)
+        if match:
+            return json.loads(match.group(0)), True
 
-            match = re.search(r"\{.*\}", result_text, re.DOTALL)
-            if match:
-                analysis = json.loads(match.group(0))
-                weakness_result[unit] = analysis
-            else:
-                weakness_result[unit] = {
-                    "weakness": "分析失敗",
-                    "suggestions": ["請繼續學習"],
-                    "confidence": "低",
-                }
+        mark_llm_parse_failure()
+        return {
+            "weakness": "分析失敗",
+            "suggestions": ["請繼續學習"],
+            "confidence": "低",
+        }, False
 
-        except Exception as e:
-            print(f"單元 {unit} 弱點分析錯誤: {e}")
+    except Exception as e:
+        mark_llm_parse_failure()
+        print(f"單元 {unit} 弱點分析錯誤: {e}")
+        return {
+            "weakness": "系統分析時發生錯誤",
+            "suggestions": ["請稍後再試"],
+            "confidence": "低",
+        }, False
+
+
+def get_unit_watermarks(cursor, username):
+    """各單元最新一筆對話的 id，作為弱點分析快取是否過期的依據"""
+    cursor.execute(
+        """
+        SELECT learning_unit, MAX(id) 
+        FROM conversations 
+        WHERE username = ? AND learning_unit IS NOT NULL 
+        GROUP BY learning_unit
+    """,
+        (username,),
+    )
+    return dict(cursor.fetchall())
+
+
+def load_cached_weakness(cursor, username, watermarks):
+    """讀出仍然有效（該單元沒有新對話）的弱點分析"""
+    cursor.execute(
+        """
+        SELECT learning_unit, last_conversation_id, result 
+        FROM weakness_cache 
+        WHERE username = ?
+    """,
+        (username,),
+    )
+    return {
+        unit: json.loads(result)
+        for unit, last_id, result in cursor.fetchall()
+        if watermarks.get(unit) == last_id
+    }
+
+
+def load_failed_weakness_units(cursor, username, watermarks):
+    """最近重試用盡而失敗、且該單元之後沒有新對話的弱點分析工作所屬單元"""
+    cursor.execute(
+        """
+        SELECT json_extract(payload, '$.unit'), json_extract(payload, '$.watermark') 
+        FROM jobs 
+        WHERE owner = ? AND kind = 'unit_weakness' AND status = 'failed' 
+          AND updated_at >= datetime('now', ?)
+    """,
+        (username, f"-{WEAKNESS_FAILED_COOLDOWN_SECONDS} seconds"),
+    )
+    return {
+        unit
+        for unit, watermark in cursor.fetchall()
+        if watermarks.get(unit) == watermark
+    }
+
+
+def store_cached_weakness(conn, username, unit, last_conversation_id, analysis):
+    conn.execute(
+        """
+        INSERT INTO weakness_cache (username, learning_unit, last_conversation_id, result, updated_at)
+        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(username, learning_unit) DO UPDATE SET
+            last_conversation_id = excluded.last_conversation_id,
+            result = excluded.result,
+            updated_at = excluded.updated_at
+    """,
+        (
+            username,
+            unit,
+            last_conversation_id,
+            json.dumps(analysis, ensure_ascii=False),
+        ),
+    )
+    conn.commit()
+
+
+def refresh_unit_weakness(username, unit):
+    """
+    重新分析單一學生單一單元的弱點並寫入快取；快取仍有效或對話不足時不做事。
+    分析失敗時丟出例外，交給工作佇列重試。
+    """
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute(
+            """
+            SELECT MAX(id), COUNT(*) 
+            FROM conversations 
+            WHERE username = ? AND learning_unit = ?
+        """,
+            (username, unit),
+        )
+        watermark, count = c.fetchone()
+        if count < 3:
+            return
+        if unit in load_cached_weakness(c, username, {unit: watermark}):
+            return
+
+        c.execute(
+            """
+            SELECT CASE WHEN id < ? THEN ? ELSE user_message END, understanding_level, scaffolding_type 
+            FROM conversations 
+            WHERE username = ? AND learning_unit = ? 
+            ORDER BY timestamp DESC 
+            LIMIT 5
+        """,
+            (get_clear_watermark(c, username), CLEARED_MESSAGE, username, unit),
+        )
+        convs = [
+            {"message": message, "level": level, "scaffolding": scaffolding}
+            for message, level, scaffolding in c.fetchall()
+        ]
+
+    # 呼叫 GPT 時不佔用資料庫連線
+    analysis, cacheable = analyze_single_unit_weakness(unit, convs, username)
+    if not cacheable:
+        raise RuntimeError(f"單元 {unit} 弱點分析失敗: {analysis['weakness']}")
+
+    with db_connection() as conn:
+        store_cached_weakness(conn, username, unit, watermark, analysis)
+
+
+WEAKNESS_FAILED_RESULT = {
+    "weakness": "分析失敗，請稍後再試",
+    "suggestions": [],
+    "confidence": "低",
+}
+
+
+def analyze_unit_weakness(conversations, username):
+    """
+    使用 GPT 分析各單元的弱點。
+    結果依 (使用者, 單元, 該單元最新對話 id) 存在 weakness_cache，單元沒有新對話就直接沿用。
+    需要重新分析的單元送進背景工作佇列，最多等待 WEAKNESS_DEADLINE_SECONDS 秒，
+    尚未完成的回傳「分析中」，由前端輪詢 /my_learning/weakness_status。
+    重試用盡而失敗的單元在沒有新對話前不重新排入（見 WEAKNESS_FAILED_COOLDOWN_SECONDS）。
+    回傳 (各單元分析結果, 各單元來源："cached" / "fresh" / "pending" / "failed")。
+    """
+    deadline = time.monotonic() + WEAKNESS_DEADLINE_SECONDS
+    unit_conversations = group_unit_conversations(conversations)
+
+    with db_connection() as conn:
+        c = conn.cursor()
+        watermarks = get_unit_watermarks(c, username)
+        cached = load_cached_weakness(c, username, watermarks)
+        failed = load_failed_weakness_units(c, username, watermarks)
+
+    weakness_result = {}
+    sources = {}
+    job_ids = {}
+
+    for unit, convs in unit_conversations.items():
+        # 只分析有足夠對話記錄的單元（至少3次對話）
+        if len(convs) < 3:
+            weakness_result[unit] = {
+                "weakness": "對話次數不足，尚無法分析弱點",
+                "suggestions": ["建議多與 AI 討論此單元的內容"],
+                "confidence": "低",
+            }
+            sources[unit] = "fresh"
+            continue
+
+        if unit in cached:
+            weakness_result[unit] = cached[unit]
+            sources[unit] = "cached"
+            continue
+
+        if unit in failed:
+            weakness_result[unit] = dict(WEAKNESS_FAILED_RESULT)
+            sources[unit] = "failed"
+            continue
+
+        # watermark 讓之後能分辨失敗的工作是否針對目前的對話
+        job_ids[unit] = enqueue_job(
+            "unit_weakness",
+            {"username": username, "unit": unit, "watermark": watermarks.get(unit)},
+            owner=username,
+            dedupe_key=f"unit_weakness:{username}:{unit}",
+        )
+
+    statuses = {}
+    if job_ids and WEAKNESS_DEADLINE_SECONDS > 0:
+        wait_for_jobs(job_ids.values(), deadline)
+        statuses = get_job_statuses(job_ids.values())
+        with db_connection() as conn:
+            cached = load_cached_weakness(conn.cursor(), username, watermarks)
+
+    for unit, job_id in job_ids.items():
+        if unit in cached:
+            weakness_result[unit] = cached[unit]
+            sources[unit] = "fresh"
+        elif statuses.get(job_id) == "failed":
+            weakness_result[unit] = dict(WEAKNESS_FAILED_RESULT)
+            sources[unit] = "failed"
+        else:
             weakness_result[unit] = {
-                "weakness": "系統分析時發生錯誤",
-                "suggestions": ["請稍後再試"],
+                "weakness": "分析中，請稍後重新整理",
+                "suggestions": [],
                 "confidence": "低",
             }
+            sources[unit] = "pending"
 
-    return weakness_result
+    # 保持單元原本的順序
+    return {unit: weakness_result[unit] for unit in unit_conversations}, sources
 
 
 def calculate_overall_stats(conversations):
@@ -1481,22 +4063,440 @@ def clear_chat():
         return jsonify({"error": "未登入"}), 401
 
     username = session["username"]
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db()
     c = conn.cursor()
 
+    # 只記錄水位（單列寫入），內容由 scrub_cleared_chats 背景工作分批改寫
     c.execute(
-        """UPDATE conversations 
-           SET user_message = '[已清除]', bot_reply = '[已清除]' 
-           WHERE username = ?""",
-        (username,),
+        """
+        INSERT INTO chat_clear_marks (username, cleared_before_id) 
+        VALUES (?, (SELECT COALESCE(MAX(id), 0) + 1 FROM conversations WHERE username = ?)) 
+        ON CONFLICT(username) DO UPDATE SET 
+            cleared_before_id = MAX(cleared_before_id, excluded.cleared_before_id), 
+            cleared_at = CURRENT_TIMESTAMP
+    """,
+        (username, username),
     )
+    # 弱點分析是由清除前的對話內容產生的，一併刪除，下次查看時以遮蔽後的內容重新分析
+    c.execute("DELETE FROM weakness_cache WHERE username = ?", (username,))
+    bump_data_version(c)
 
     conn.commit()
-    conn.close()
+    history_cache.invalidate(username)
+    enqueue_job("scrub_cleared_chats", {}, dedupe_key="scrub_cleared_chats")
 
     return jsonify({"success": True})
 
 
+def get_clear_watermark(cursor, username):
+    """id 小於此值的對話已被使用者清除（沒有清除過為 0）"""
+    cursor.execute(
+        "SELECT cleared_before_id FROM chat_clear_marks WHERE username = ?",
+        (username,),
+    )
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+###########################################################################  => jobs
+# 背景工作佇列：工作存在 jobs 資料表，由 worker 執行緒領取執行。
+# process 重啟時尚未完成的工作仍留在資料表中，之後會再被領取。
+_job_workers_lock = threading.Lock()
+_job_workers_started = False
+
+
+def job_handler(kind):
+    """註冊某種工作的處理函式 handler(job)，job 含 id、kind、payload、attempts、checkpoint"""
+
+    def decorator(func):
+        job_handlers[kind] = func
+        return func
+
+    return decorator
+
+
+def enqueue_job(kind, payload, owner=None, dedupe_key=None, max_attempts=None):
+    """
+    送出工作並回傳工作 id。
+    相同 dedupe_key 已有排隊中或執行中的工作時不重複建立，直接回傳該工作的 id。
+    """
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute(
+            """
+            INSERT OR IGNORE INTO jobs (kind, payload, owner, dedupe_key, max_attempts) 
+            VALUES (?, ?, ?, ?, ?)
+        """,
+            (
+                kind,
+                json.dumps(payload, ensure_ascii=False),
+                owner,
+                dedupe_key,
+                max_attempts or JOB_MAX_ATTEMPTS,
+            ),
+        )
+        if c.rowcount:
+            job_id = c.lastrowid
+        else:
+            # INSERT 已取得寫入鎖，既有的工作在交易結束前不會變成完成狀態
+            c.execute(
+                "SELECT id FROM jobs WHERE dedupe_key = ? AND status IN ('queued', 'running')",
+                (dedupe_key,),
+            )
+            job_id = c.fetchone()[0]
+        conn.commit()
+
+    job_wakeup.set()
+    return job_id
+
+
+def get_job_statuses(job_ids):
+    job_ids = list(job_ids)
+    if not job_ids:
+        return {}
+    placeholders = ", ".join("?" * len(job_ids))
+    with db_connection() as conn:
+        rows = conn.execute(
+            f"SELECT id, status FROM jobs WHERE id IN ({placeholders})", job_ids
+        ).fetchall()
+    return dict(rows)
+
+
+def wait_for_jobs(job_ids, deadline):
+    """等待工作全部結束（done / failed）或超過期限；工作可能由其他 process 執行，所以輪詢資料表"""
+    job_ids = list(job_ids)
+    while time.monotonic() < deadline:
+        statuses = get_job_statuses(job_ids)
+        if all(status in ("done", "failed") for status in statuses.values()):
+            return True
+        time.sleep(min(0.2, max(0, deadline - time.monotonic())))
+    return False
+
+
+def claim_next_job():
+    """領取一個可執行的工作並標記為 running；沒有工作時回傳 None"""
+    with db_connection() as conn:
+        # 單一 UPDATE 完成選取與標記，多個 worker 不會領到同一個工作
+        rows = conn.execute(
+            """
+            UPDATE jobs 
+            SET status = 'running', attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP 
+            WHERE id = (
+                SELECT id FROM jobs 
+                WHERE status = 'queued' AND run_after <= CURRENT_TIMESTAMP 
+                ORDER BY id 
+                LIMIT 1
+            )
+            RETURNING id, kind, payload, attempts, max_attempts, checkpoint
+        """
+        ).fetchall()
+        conn.commit()
+
+    if not rows:
+        return None
+
+    job_id, kind, payload, attempts, max_attempts, checkpoint = rows[0]
+    return {
+        "id": job_id,
+        "kind": kind,
+        "payload": json.loads(payload),
+        "attempts": attempts,
+        "max_attempts": max_attempts,
+        "checkpoint": checkpoint,
+    }
+
+
+def save_job_checkpoint(job_id, checkpoint):
+    """記錄長時間工作的進度，同時更新 updated_at 表示 worker 仍在執行"""
+    with db_connection() as conn:
+        conn.execute(
+            "UPDATE jobs SET checkpoint = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (checkpoint, job_id),
+        )
+        conn.commit()
+
+
+def finish_job(job, error=None):
+    """標記工作完成；失敗時依次數以指數退避重新排隊，超過上限標記為 failed"""
+    with db_connection() as conn:
+        if error is None:
+            conn.execute(
+                """UPDATE jobs 
+                   SET status = 'done', last_error = NULL, updated_at = CURRENT_TIMESTAMP 
+                   WHERE id = ?""",
+                (job["id"],),
+            )
+        elif job["attempts"] < job["max_attempts"]:
+            delay = JOB_RETRY_BASE_SECONDS * 2 ** (job["attempts"] - 1)
+            conn.execute(
+                """UPDATE jobs 
+                   SET status = 'queued', run_after = datetime('now', ?), 
+                       last_error = ?, updated_at = CURRENT_TIMESTAMP 
+                   WHERE id = ?""",
+                (f"+{delay} seconds", error, job["id"]),
+            )
+        else:
+            conn.execute(
+                """UPDATE jobs 
+                   SET status = 'failed', last_error = ?, updated_at = CURRENT_TIMESTAMP 
+                   WHERE id = ?""",
+                (error, job["id"]),
+            )
+        conn.commit()
+
+
+def run_job(job):
+    handler = job_handlers.get(job["kind"])
+    try:
+        if handler is None:
+            raise ValueError(f"未知的工作類型: {job['kind']}")
+        handler(job)
+    except Exception as e:
+        print(f"工作 {job['id']}（{job['kind']}）第 {job['attempts']} 次執行失敗: {e}")
+        finish_job(job, str(e))
+    else:
+        finish_job(job)
+
+
+def drain_jobs():
+    """執行目前所有可執行的工作，佇列清空後返回"""
+    while True:
+        job = claim_next_job()
+        if job is None:
+            return
+        run_job(job)
+
+
+def job_worker_loop():
+    while True:
+        try:
+            drain_jobs()
+        except sqlite3.Error as e:
+            print(f"工作佇列資料庫錯誤: {e}")
+        job_wakeup.wait(JOB_POLL_SECONDS)
+        job_wakeup.clear()
+
+
+def enqueue_nightly_precompute(day=None):
+    """送出某天的預先計算工作；同一天已送出過（不論是否完成）則不重複送出"""
+    day = day or datetime.now().strftime("%Y-%m-%d")
+    dedupe_key = f"precompute_weakness:{day}"
+    with db_connection() as conn:
+        exists = conn.execute(
+            "SELECT 1 FROM jobs WHERE dedupe_key = ?", (dedupe_key,)
+        ).fetchone()
+    if exists:
+        return None
+    return enqueue_job("precompute_weakness", {"day": day}, dedupe_key=dedupe_key)
+
+
+def job_maintenance():
+    """
+    重新排入中斷的工作、清除過期的工作、書籍快取與 LLM 呼叫紀錄，
+    補送尚未完成的清除紀錄改寫，並在指定時刻送出每晚預先計算
+    """
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute(
+            """UPDATE jobs 
+               SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END, 
+                   last_error = 'worker 中斷', updated_at = CURRENT_TIMESTAMP 
+               WHERE status = 'running' AND updated_at < datetime('now', ?)""",
+            (f"-{JOB_STALE_SECONDS} seconds",),
+        )
+        if c.rowcount:
+            print(f"已重新處理 {c.rowcount} 個中斷的工作")
+        c.execute(
+            """DELETE FROM jobs 
+               WHERE status IN ('done', 'failed') AND updated_at < datetime('now', ?)""",
+            (f"-{JOB_RETENTION_DAYS} days",),
+        )
+        c.execute("DELETE FROM book_cache WHERE expires_at < datetime('now')")
+        c.execute(
+            "DELETE FROM llm_calls WHERE created_at < datetime('now', ?)",
+            (f"-{LLM_CALLS_RETENTION_DAYS} days",),
+        )
+        conn.commit()
+        c.execute(
+            "SELECT EXISTS (SELECT 1 FROM chat_clear_marks WHERE scrubbed_before_id < cleared_before_id)"
+        )
+        scrub_pending = c.fetchone()[0]
+
+    # 清除紀錄時工作剛好在收尾、送出被合併掉的話，由這裡補送
+    if scrub_pending:
+        enqueue_job("scrub_cleared_chats", {}, dedupe_key="scrub_cleared_chats")
+
+    if NIGHTLY_PRECOMPUTE_HOUR and datetime.now().hour == int(NIGHTLY_PRECOMPUTE_HOUR):
+        enqueue_nightly_precompute()
+
+
+def job_maintenance_loop():
+    while True:
+        try:
+            job_maintenance()
+        except sqlite3.Error as e:
+            print(f"工作佇列維護錯誤: {e}")
+        time.sleep(60)
+
+
+def start_job_workers(count=None):
+    """啟動 worker 與維護執行緒，每個 process 只啟動一次"""
+    global _job_workers_started
+    count = JOB_WORKERS if count is None else count
+    with _job_workers_lock:
+        if _job_workers_started or count <= 0:
+            return
+        _job_workers_started = True
+
+    for i in range(count):
+        threading.Thread(
+            target=job_worker_loop, name=f"job-worker-{i}", daemon=True
+        ).start()
+    threading.Thread(
+        target=job_maintenance_loop, name="job-maintenance", daemon=True
+    ).start()
+
+
+# 收到第一個請求時才啟動，CLI 指令與匯入模組不會帶起 worker
+@app.before_request
+def ensure_job_workers():
+    if not _job_workers_started:
+        start_job_workers()
+
+
+@job_handler("unit_weakness")
+def unit_weakness_job(job):
+    refresh_unit_weakness(job["payload"]["username"], job["payload"]["unit"])
+
+
+@job_handler("precompute_weakness")
+def precompute_weakness_job(job):
+    """
+    依使用者名稱順序重新分析所有學生過期的弱點分析。
+    每處理完一位學生記錄 checkpoint，中斷後重新執行會從下一位學生繼續。
+    """
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute(
+            """
+            SELECT username, value 
+            FROM student_counts 
+            WHERE dimension = 'unit' AND count >= 3 AND value != '通用概念' 
+              AND username != 'teacher' AND username > ? 
+            ORDER BY username, value
+        """,
+            (job["checkpoint"] or "",),
+        )
+        student_units = {}
+        for username, unit in c.fetchall():
+            student_units.setdefault(username, []).append(unit)
+
+    for username, units in student_units.items():
+        for unit in units:
+            # 單一單元失敗不中斷整批，學生下次開啟頁面時會再排入佇列
+            try:
+                refresh_unit_weakness(username, unit)
+            except Exception as e:
+                print(f"預先計算 {username} / {unit} 弱點分析失敗: {e}")
+        save_job_checkpoint(job["id"], username)
+
+
+@job_handler("scrub_cleared_chats")
+def scrub_cleared_chats_job(job):
+    """
+    把清除水位以前的對話內容實際改寫為 CLEARED_MESSAGE。
+    每批最多 CLEAR_SCRUB_BATCH_SIZE 筆、各自一個短交易，批次之間暫停讓其他寫入穿插；
+    進度記在 chat_clear_marks.scrubbed_before_id，中斷後從原處繼續。
+    """
+    while True:
+        with db_connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                """
+                SELECT username, cleared_before_id, scrubbed_before_id 
+                FROM chat_clear_marks 
+                WHERE scrubbed_before_id < cleared_before_id 
+                ORDER BY username 
+                LIMIT 1
+            """
+            )
+            mark = c.fetchone()
+            if mark is None:
+                return
+            username, cleared_before, scrubbed_before = mark
+
+            # 這一批的結束位置：第 CLEAR_SCRUB_BATCH_SIZE + 1 筆的 id，不足一批就做到水位
+            c.execute(
+                """
+                SELECT id FROM conversations 
+                WHERE username = ? AND id >= ? AND id < ? 
+                ORDER BY id 
+                LIMIT 1 OFFSET ?
+            """,
+                (username, scrubbed_before, cleared_before, CLEAR_SCRUB_BATCH_SIZE),
+            )
+            row = c.fetchone()
+            batch_end = row[0] if row else cleared_before
+
+            c.execute(
+                """UPDATE conversations 
+                   SET user_message = ?, bot_reply = ? 
+                   WHERE username = ? AND id >= ? AND id < ? AND user_message != ?""",
+                (
+                    CLEARED_MESSAGE,
+                    CLEARED_MESSAGE,
+                    username,
+                    scrubbed_before,
+                    batch_end,
+                    CLEARED_MESSAGE,
+                ),
+            )
+            c.execute(
+                "UPDATE chat_clear_marks SET scrubbed_before_id = ? WHERE username = ?",
+                (batch_end, username),
+            )
+            conn.commit()
+
+        # 進度以 chat_clear_marks 為準，checkpoint 只是心跳：大量對話要跑很久，
+        # 不更新 updated_at 會被 job_maintenance 當成中斷的工作重新排入
+        save_job_checkpoint(job["id"], f"{username}:{batch_end}")
+        time.sleep(CLEAR_SCRUB_PAUSE_SECONDS)
+
+
+@app.cli.command("precompute-weakness")
+@click.option("--day", help="工作日期（YYYY-MM-DD），同一天只會送出一次，預設為今天")
+def precompute_weakness_command(day):
+    job_id = enqueue_nightly_precompute(day)
+    if job_id is None:
+        print("今天的預先計算工作已送出過")
+    else:
+        print(f"已送出預先計算工作 #{job_id}")
+
+
+@app.cli.command("run-jobs")
+@click.option("--workers", type=int, default=max(JOB_WORKERS, 1), help="worker 執行緒數")
+@click.option("--once", is_flag=True, help="執行完目前可執行的工作後結束（適合搭配 cron）")
+def run_jobs_command(workers, once):
+    if once:
+        job_maintenance()
+        threads = [threading.Thread(target=drain_jobs) for _ in range(workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return
+
+    start_job_workers(workers)
+    print(f"已啟動 {workers} 個 worker，按 Ctrl+C 結束")
+    while True:
+        time.sleep(3600)
+
+
+###########################################################################
+
+
+init_db()
+
+
 if __name__ == "__main__":
-    init_db()
     app.run(debug=True)
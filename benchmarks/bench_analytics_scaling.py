@@ -0,0 +1,220 @@
+"""
+個人學習分析純函式的規模測試：輸入筆數從 10 到 1M 時的執行時間與記憶體配置。
+
+量測 analyze_unit_progress、calculate_overall_stats、calculate_scaffolding_stats、
+generate_learning_timeline（輸入為 /my_learning_analytics 查詢得到的
+(單元, 理解程度, 訊息, 鷹架類型, 時間) tuple，新的在前），以及逐筆呼叫
+identify_learning_unit 分類同樣筆數的訊息。資料由 make_synthetic_db.py 的產生器建立。
+
+時間：先校準迴圈次數，讓每個樣本至少 --min-sample-ms，共取 --repeat 個樣本；
+比較與成長階數使用最快的樣本（較不受其他行程干擾），另外列出中位數。
+記憶體：另外執行一次並以 tracemalloc 記錄呼叫期間的峰值配置（與計時分開，避免 tracemalloc 拖慢計時）。
+計時期間與 timeit 一樣關閉垃圾回收，並以 gc.freeze() 把輸入資料移出回收範圍，
+避免大量存活的 tuple 讓偶發的完整回收干擾樣本。
+另以最大兩個規模估算成長階數 k（時間 ∝ n^k），用來發現不小心寫成 O(n²) 的迴圈。
+
+--output 存成基準檔；--compare 與基準檔比較，時間變慢超過 --time-tolerance、
+峰值記憶體增加超過 --memory-tolerance，或 k 超過 --max-exponent 時回傳 1。
+基準檔應在同一台機器上產生，時間才有可比性。
+
+執行方式（於專案根目錄）：
+    python benchmarks/bench_analytics_scaling.py --output analytics_baseline.json
+    python benchmarks/bench_analytics_scaling.py --compare analytics_baseline.json
+"""
+
+import argparse
+import gc
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import make_synthetic_db  # noqa: E402  （會設定環境變數並匯入 app）
+
+app = make_synthetic_db.app
+
+SIZES = "10,100,1000,10000,100000,1000000"
+
+
+def build_rows(size, seed):
+    """/my_learning_analytics 的查詢結果格式，新的在前"""
+    names = make_synthetic_db.student_names(1)
+    rows = [
+        (unit, level, message, scaffolding, timestamp)
+        for _, message, _, unit, scaffolding, level, _, timestamp in (
+            make_synthetic_db.generate_conversations(names, size, 180, random.Random(seed))
+        )
+    ]
+    rows.reverse()
+    return rows
+
+
+def classify_messages(rows):
+    return [app.identify_learning_unit(row[2]) for row in rows]
+
+
+FUNCTIONS = {
+    "analyze_unit_progress": lambda rows: app.analyze_unit_progress(rows),
+    "calculate_overall_stats": lambda rows: app.calculate_overall_stats(rows),
+    "calculate_scaffolding_stats": lambda rows: app.calculate_scaffolding_stats(rows),
+    "generate_learning_timeline": lambda rows: app.generate_learning_timeline(rows),
+    "identify_learning_unit": classify_messages,
+}
+
+
+def time_call(func, rows, repeat, min_sample_ms):
+    """回傳每次呼叫的毫秒數：(最快樣本, 中位數)，計時期間關閉垃圾回收"""
+    gc.collect()
+    gc.disable()
+    try:
+        return _time_samples(func, rows, repeat, min_sample_ms)
+    finally:
+        gc.enable()
+
+
+def _time_samples(func, rows, repeat, min_sample_ms):
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            func(rows)
+        elapsed = (time.perf_counter() - start) * 1000
+        if elapsed >= min_sample_ms or loops >= 1_000_000:
+            break
+        loops *= 10 if elapsed < min_sample_ms / 10 else 2
+
+    samples = [elapsed / loops]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            func(rows)
+        samples.append((time.perf_counter() - start) * 1000 / loops)
+    return min(samples), statistics.median(samples)
+
+
+def peak_allocation(func, rows):
+    """呼叫期間的峰值配置（KB），不含輸入資料本身"""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        func(rows)
+        return (tracemalloc.get_traced_memory()[1] - before) / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def growth_exponent(points):
+    """以最大兩個規模估算 k（時間 ∝ n^k）"""
+    points = [(n, ms) for n, ms in points if ms > 0]
+    if len(points) < 2:
+        return None
+    (n1, t1), (n2, t2) = points[-2:]
+    return round(math.log(t2 / t1) / math.log(n2 / n1), 2)
+
+
+def compare(results, baseline, args):
+    """與基準檔比較，回傳退步項目的清單"""
+    regressions = []
+    base = {(r["function"], r["size"]): r for r in baseline["results"]}
+    for r in results:
+        b = base.get((r["function"], r["size"]))
+        if b is None:
+            continue
+        slower = r["time_ms"] > b["time_ms"] * (1 + args.time_tolerance)
+        # 小於 1KB 的配置差異視為雜訊
+        heavier = r["peak_kb"] > b["peak_kb"] * (1 + args.memory_tolerance) + 1
+        if slower or heavier:
+            print(
+                f"{r['function']:>28} n={r['size']:<8} "
+                f"time {b['time_ms']} -> {r['time_ms']}ms, peak {b['peak_kb']} -> {r['peak_kb']}KB  退步"
+            )
+            regressions.append((r["function"], r["size"], "time" if slower else "memory"))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default=SIZES, help="輸入筆數，以逗號分隔")
+    parser.add_argument("--functions", default=",".join(FUNCTIONS), help="要量測的函式")
+    parser.add_argument("--repeat", type=int, default=5, help="每個規模的樣本數")
+    parser.add_argument("--min-sample-ms", type=float, default=100, help="每個樣本的最短時間")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="將結果寫成 JSON 基準檔")
+    parser.add_argument("--compare", help="與先前的 JSON 基準檔比較")
+    parser.add_argument("--time-tolerance", type=float, default=0.25, help="允許變慢的比例")
+    parser.add_argument("--memory-tolerance", type=float, default=0.10, help="允許峰值記憶體增加的比例")
+    parser.add_argument("--max-exponent", type=float, default=1.3, help="允許的最大成長階數 k")
+    args = parser.parse_args()
+
+    sizes = sorted(int(s) for s in args.sizes.split(","))
+    functions = args.functions.split(",")
+    # 只產生一次最大規模的資料，小規模取最新的前 n 筆
+    all_rows = build_rows(sizes[-1], args.seed)
+    gc.collect()
+    gc.freeze()
+
+    results = []
+    exponents = {}
+    for name in functions:
+        func = FUNCTIONS[name]
+        points = []
+        for size in sizes:
+            rows = all_rows[:size]
+            time_ms, median_ms = time_call(func, rows, args.repeat, args.min_sample_ms)
+            peak_kb = peak_allocation(func, rows)
+            points.append((size, time_ms))
+            results.append(
+                {
+                    "function": name,
+                    "size": size,
+                    "time_ms": round(time_ms, 4),
+                    "median_ms": round(median_ms, 4),
+                    "us_per_row": round(time_ms * 1000 / size, 3),
+                    "peak_kb": round(peak_kb, 1),
+                }
+            )
+            print(
+                f"{name:>28} n={size:<8} {time_ms:10.3f}ms (中位數 {median_ms:.3f}ms) "
+                f"({time_ms * 1000 / size:.3f}us/筆) peak={peak_kb:.1f}KB"
+            )
+        exponents[name] = growth_exponent(points)
+        print(f"{name:>28} 成長階數 k≈{exponents[name]}")
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": vars(args),
+        },
+        "results": results,
+        "exponents": exponents,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    regressions = [
+        (name, "exponent")
+        for name, k in exponents.items()
+        if k is not None and k > args.max_exponent
+    ]
+    for name, _ in regressions:
+        print(f"{name}: 成長階數 {exponents[name]} 超過 {args.max_exponent}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions += compare(results, json.load(f), args)
+    if regressions:
+        print(f"{len(regressions)} 項退步超過門檻")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
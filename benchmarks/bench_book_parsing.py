@@ -0,0 +1,96 @@
+"""
+比較博客來搜尋結果頁的解析時間：原本的 BeautifulSoup html.parser 與 parse_book_results（lxml）。
+
+使用 benchmarks/fixtures/ 中存下來的搜尋結果頁（也可用 --pages 指定其他存檔），
+每一頁各解析 --iterations 次，回報平均與 p95 毫秒數，以及解析出的書籍數。
+
+執行方式（於專案根目錄）：
+    python benchmarks/bench_book_parsing.py --iterations 50
+"""
+
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+os.environ["DB_NAME"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+os.environ["JOB_WORKERS"] = "0"  # 不啟動背景工作 worker，避免干擾量測
+
+import app  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "books_search_*.html")
+
+
+def parse_with_bs4(html):
+    """原本 search_books_google 的解析方式（整頁 html.parser，只取第一本），沒有結果時回傳空清單"""
+    soup = BeautifulSoup(html, "html.parser")
+    a_tag = soup.select_one(".table-td a")
+    author = soup.select_one(".author a")
+    img_tag = soup.select_one(".table-td img")
+    if not (a_tag and a_tag.has_attr("title") and img_tag):
+        return []
+    return [
+        {
+            "title": a_tag["title"],
+            "author": author.text if author else "",
+            "image": img_tag.get("data-src") or img_tag.get("src"),
+            "link": a_tag["href"],
+            "source": "博客來",
+        }
+    ]
+
+
+def measure(parse, html, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        books = parse(html)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        "books": len(books),
+        "mean_ms": round(statistics.mean(timings), 3),
+        "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--pages", default=FIXTURES, help="要解析的 HTML 存檔（glob）")
+    parser.add_argument("--output", help="將結果寫成 JSON 檔")
+    args = parser.parse_args()
+
+    parsers = {
+        "bs4_html_parser": parse_with_bs4,
+        "lxml_parse_book_results": app.parse_book_results,
+    }
+
+    results = []
+    for path in sorted(glob.glob(args.pages)):
+        with open(path, encoding="utf-8") as f:
+            html = f.read()
+        for name, parse in parsers.items():
+            r = measure(parse, html, args.iterations)
+            r.update(page=os.path.basename(path), size_kb=round(len(html.encode()) / 1024), parser=name)
+            results.append(r)
+            print(
+                f"{r['page']:>28} ({r['size_kb']}KB) {name:>24}: "
+                f"mean={r['mean_ms']}ms p95={r['p95_ms']}ms books={r['books']}"
+            )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+比較 /chat 兩段式流程（two_call）與合併模式（fused）的延遲。
+
+以模擬的 OpenAI 客戶端取代真正的 API：每次呼叫的延遲 = 固定往返時間 + 每個輸出 token 的時間，
+因此結果反映的是「呼叫次數」與「輸出長度」對延遲的影響，而不是實際網路狀況。
+
+執行方式（於專案根目錄）：
+    python benchmarks/bench_chat_modes.py --iterations 20 --rtt-ms 400 --token-ms 15
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+os.environ["DB_NAME"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+
+import app  # noqa: E402
+
+ANALYSIS_JSON = {
+    "scaffolding_type": "重複鷹架",
+    "understanding_level": "初學者",
+    "reason": "學生需要鞏固過度擬合的概念",
+}
+REPLY_TEXT = "過度擬合是模型把訓練資料的雜訊也學起來。就像死背考古題，換題目就不會。可以用交叉驗證檢查泛化能力。你能想到其他避免的方法嗎？"
+
+
+class SimulatedCompletions:
+    """依請求內容回傳對應格式的假回覆，並模擬延遲"""
+
+    def __init__(self, rtt_ms, token_ms):
+        self.rtt_ms = rtt_ms
+        self.token_ms = token_ms
+        self.calls = 0
+
+    def create(self, **kwargs):
+        self.calls += 1
+        prompt = kwargs["messages"][-1]["content"]
+
+        if '"reply"' in prompt:
+            content = json.dumps(
+                dict(ANALYSIS_JSON, reply=REPLY_TEXT), ensure_ascii=False
+            )
+        elif "JSON" in prompt:
+            content = json.dumps(ANALYSIS_JSON, ensure_ascii=False)
+        else:
+            content = REPLY_TEXT
+
+        # 粗估：中文一個字約一個 token
+        time.sleep((self.rtt_ms + self.token_ms * len(content)) / 1000)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))]
+        )
+
+
+def run_mode(mode, iterations, completions):
+    app.CHAT_PIPELINE_MODE = mode
+    history = [("什麼是回歸?", "線性回歸", "差異鷹架", "初學者")]
+    latencies = []
+    calls_before = completions.calls
+
+    for _ in range(iterations):
+        start = time.perf_counter()
+        app.run_scaffolding_pipeline("什麼是過度擬合?", "多項式回歸", history, "bench")
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "iterations": iterations,
+        "llm_calls_per_request": (completions.calls - calls_before) / iterations,
+        "mean_ms": round(statistics.mean(latencies), 1),
+        "p50_ms": round(latencies[len(latencies) // 2], 1),
+        "p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--rtt-ms", type=float, default=400, help="每次呼叫的固定往返延遲")
+    parser.add_argument("--token-ms", type=float, default=15, help="每個輸出 token 的產生時間")
+    parser.add_argument("--output", help="將結果寫成 JSON 檔")
+    args = parser.parse_args()
+
+    completions = SimulatedCompletions(args.rtt_ms, args.token_ms)
+    app.client.backend = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    # 每次送出相同訊息，關閉回覆快取才不會讓 two_call 從第二次起略過產生回覆的呼叫
+    app.response_cache.max_size = 0
+
+    results = [
+        run_mode("two_call", args.iterations, completions),
+        run_mode("fused", args.iterations, completions),
+    ]
+
+    for r in results:
+        print(
+            f"{r['mode']:>9}: calls/req={r['llm_calls_per_request']:.1f} "
+            f"mean={r['mean_ms']}ms p50={r['p50_ms']}ms p95={r['p95_ms']}ms"
+        )
+    saved = results[0]["mean_ms"] - results[1]["mean_ms"]
+    print(f"fused 平均節省 {saved:.1f}ms / 請求")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(
+                {"config": vars(args), "results": results}, f, ensure_ascii=False, indent=2
+            )
+
+
+if __name__ == "__main__":
+    main()
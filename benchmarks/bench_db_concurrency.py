@@ -0,0 +1,145 @@
+"""
+教師儀表板持續查詢時，/chat 的吞吐量。
+
+建立一個含合成對話資料的暫存資料庫，同時啟動多個「學生」執行緒不斷呼叫 /chat，
+以及多個「教師」執行緒不斷呼叫 /teacher_analytics，分別以 DELETE（預設 rollback journal）
+與 WAL 模式各跑一次，比較 /chat 每秒完成數與錯誤數。LLM 以零延遲的假客戶端取代。
+
+執行方式（於專案根目錄）：
+    python benchmarks/bench_db_concurrency.py --seconds 5 --students 8 --teachers 4
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+os.environ["JOB_WORKERS"] = "0"  # 不啟動背景工作 worker，避免干擾量測
+os.environ["DB_NAME"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+
+import app  # noqa: E402
+
+UNITS = list(app.LEARNING_UNITS)
+SCAFFOLDS = ["差異鷹架", "重複鷹架", "協同鷹架"]
+LEVELS = ["初學者", "進階學習者", "熟練者"]
+
+
+class InstantCompletions:
+    def create(self, **kwargs):
+        if "JSON" in kwargs["messages"][-1]["content"]:
+            content = json.dumps(
+                {"scaffolding_type": "差異鷹架", "understanding_level": "初學者", "reason": "bench"},
+                ensure_ascii=False,
+            )
+        else:
+            content = "這是一段測試回覆。"
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))]
+        )
+
+
+def build_database(path, students, conversations):
+    app.DB_NAME = path
+    app.init_db()
+    conn = app.sqlite3.connect(path)
+    rng = random.Random(42)
+    conn.executemany(
+        """INSERT INTO conversations
+           (username, user_message, bot_reply, learning_unit, scaffolding_type, understanding_level, timestamp)
+           VALUES (?, ?, ?, ?, ?, ?, datetime('now', ?))""",
+        (
+            (
+                f"student{rng.randrange(students)}",
+                "問題",
+                "回覆",
+                rng.choice(UNITS),
+                rng.choice(SCAFFOLDS),
+                rng.choice(LEVELS),
+                f"-{rng.randrange(60 * 24 * 30)} minutes",
+            )
+            for _ in range(conversations)
+        ),
+    )
+    app.rebuild_student_summary(conn.cursor())
+    conn.commit()
+    conn.close()
+
+
+def run(journal_mode, args):
+    app.SQLITE_JOURNAL_MODE = journal_mode
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    build_database(path, args.population, args.conversations)
+
+    stop = threading.Event()
+    counts = {"chat": 0, "chat_errors": 0, "dashboard": 0}
+    lock = threading.Lock()
+
+    def student(i):
+        client = app.app.test_client()
+        with client.session_transaction() as s:
+            s["username"] = f"student{i}"
+        while not stop.is_set():
+            r = client.post("/chat", json={"message": "什麼是過度擬合?"})
+            with lock:
+                counts["chat" if r.status_code == 200 else "chat_errors"] += 1
+
+    def teacher():
+        client = app.app.test_client()
+        with client.session_transaction() as s:
+            s["username"] = "teacher"
+        while not stop.is_set():
+            client.get("/teacher_analytics")
+            with lock:
+                counts["dashboard"] += 1
+
+    threads = [threading.Thread(target=student, args=(i,)) for i in range(args.students)]
+    threads += [threading.Thread(target=teacher) for _ in range(args.teachers)]
+    for t in threads:
+        t.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    return {
+        "journal_mode": journal_mode,
+        "chat_per_sec": round(counts["chat"] / args.seconds, 1),
+        "chat_errors": counts["chat_errors"],
+        "dashboard_per_sec": round(counts["dashboard"] / args.seconds, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--students", type=int, default=8, help="同時送出 /chat 的執行緒數")
+    parser.add_argument("--teachers", type=int, default=4, help="同時查詢儀表板的執行緒數")
+    parser.add_argument("--population", type=int, default=300, help="合成資料中的學生人數")
+    parser.add_argument("--conversations", type=int, default=20000)
+    parser.add_argument("--output", help="將結果寫成 JSON 檔")
+    args = parser.parse_args()
+
+    app.client.backend = SimpleNamespace(chat=SimpleNamespace(completions=InstantCompletions()))
+    app.response_cache.max_size = 0  # 每次都走完整流程
+
+    results = [run("DELETE", args), run("WAL", args)]
+    for r in results:
+        print(
+            f"{r['journal_mode']:>6}: /chat {r['chat_per_sec']}/s "
+            f"(errors={r['chat_errors']}), /teacher_analytics {r['dashboard_per_sec']}/s"
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
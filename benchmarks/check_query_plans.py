@@ -0,0 +1,153 @@
+"""
+檢查熱門查詢的 EXPLAIN QUERY PLAN，以及 /teacher_analytics 的查詢數。
+
+在暫存資料庫上套用全部遷移後：
+1. 逐一執行 EXPLAIN QUERY PLAN，出現對 conversations / chat_clear_marks 的整表掃描（SCAN 且未使用索引）即失敗
+2. 分別在 1 位與 50 位學生的資料上呼叫 /teacher_analytics，執行的 SQL 數不同即失敗（N+1 查詢）
+任何一項失敗都以非零狀態結束，可放在 CI 中防止效能退化。
+
+執行方式（於專案根目錄）：
+    python benchmarks/check_query_plans.py
+"""
+
+import os
+import sys
+import tempfile
+
+os.environ["DB_NAME"] = os.path.join(tempfile.mkdtemp(), "plans.db")
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+os.environ["JOB_WORKERS"] = "0"  # 不啟動背景工作 worker，避免干擾量測
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+# 名稱 -> (SQL, 參數)；與 app.py 中實際執行的 SQL 保持一致
+HOT_QUERIES = {
+    "get_user_learning_history": (
+        """SELECT CASE WHEN id < ? THEN ? ELSE user_message END,
+                  learning_unit, scaffolding_type, understanding_level
+           FROM conversations WHERE username = ? ORDER BY timestamp DESC LIMIT ?""",
+        (0, app.CLEARED_MESSAGE, "alice", app.USER_HISTORY_LIMIT),
+    ),
+    "get_clear_watermark": (
+        "SELECT cleared_before_id FROM chat_clear_marks WHERE username = ?",
+        ("alice",),
+    ),
+    "chat_history_page": (
+        """SELECT * FROM (
+               SELECT id, user_message, bot_reply, learning_unit, scaffolding_type, understanding_level
+               FROM conversations WHERE username = ? AND id < ? AND id >= ?
+               ORDER BY id DESC LIMIT ?
+           ) ORDER BY id ASC""",
+        ("alice", sys.maxsize, 0, app.CHAT_HISTORY_PAGE_SIZE),
+    ),
+    "chat_history_since": (
+        """SELECT id, user_message, bot_reply, learning_unit, scaffolding_type, understanding_level
+           FROM conversations WHERE username = ? AND id > ? AND id >= ?
+           ORDER BY id ASC LIMIT ?""",
+        ("alice", 100, 0, app.CHAT_HISTORY_PAGE_SIZE),
+    ),
+    "chat_history_has_older": (
+        """SELECT EXISTS (SELECT 1 FROM conversations
+           WHERE username = ? AND id >= ? AND id < ?)""",
+        ("alice", 0, 100),
+    ),
+    "chat_history_has_newer": (
+        """SELECT EXISTS (SELECT 1 FROM conversations
+           WHERE username = ? AND id >= ? AND id > ?)""",
+        ("alice", 0, 100),
+    ),
+    "my_learning_analytics": (
+        """SELECT learning_unit, understanding_level,
+                  CASE WHEN id < ? THEN ? ELSE user_message END, scaffolding_type, timestamp
+           FROM conversations WHERE username = ? ORDER BY timestamp DESC""",
+        (0, app.CLEARED_MESSAGE, "alice"),
+    ),
+    "clear_chat_mark": (
+        """INSERT INTO chat_clear_marks (username, cleared_before_id)
+           VALUES (?, (SELECT COALESCE(MAX(id), 0) + 1 FROM conversations WHERE username = ?))
+           ON CONFLICT(username) DO UPDATE SET
+               cleared_before_id = MAX(cleared_before_id, excluded.cleared_before_id),
+               cleared_at = CURRENT_TIMESTAMP""",
+        ("alice", "alice"),
+    ),
+    "scrub_batch_end": (
+        """SELECT id FROM conversations
+           WHERE username = ? AND id >= ? AND id < ?
+           ORDER BY id LIMIT 1 OFFSET ?""",
+        ("alice", 0, 100, app.CLEAR_SCRUB_BATCH_SIZE),
+    ),
+    "scrub_batch_update": (
+        """UPDATE conversations SET user_message = ?, bot_reply = ?
+           WHERE username = ? AND id >= ? AND id < ? AND user_message != ?""",
+        (app.CLEARED_MESSAGE, app.CLEARED_MESSAGE, "alice", 0, 100, app.CLEARED_MESSAGE),
+    ),
+}
+
+# 以學生為單位查詢的資料表，出現整表掃描即視為退化
+GUARDED_TABLES = ("conversations", "chat_clear_marks")
+
+
+def full_scans(conn, sql, params):
+    """回傳查詢計畫中對 GUARDED_TABLES 的整表掃描步驟"""
+    plan = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    details = [row[3] for row in plan]
+    return [
+        d
+        for d in details
+        if any(d.startswith(f"SCAN {table}") for table in GUARDED_TABLES)
+        and "INDEX" not in d
+    ]
+
+
+def count_dashboard_queries(students):
+    """在有 students 位學生的新資料庫上呼叫一次 /teacher_analytics，回傳執行的 SQL 數"""
+    app.DB_NAME = os.path.join(tempfile.mkdtemp(), f"students_{students}.db")
+    app.init_db()
+
+    with app.db_connection() as conn:
+        conn.executemany(
+            """INSERT INTO conversations
+               (username, user_message, bot_reply, learning_unit, scaffolding_type, understanding_level)
+               VALUES (?, '問題', '回覆', '線性回歸', '差異鷹架', '初學者')""",
+            [(f"student{i}",) for i in range(students) for _ in range(3)],
+        )
+        app.rebuild_student_summary(conn.cursor())
+        conn.commit()
+
+    # 只計算重新計算整份資料的查詢數，不讓儀表板快取影響結果
+    app.dashboard_cache.clear()
+
+    statements = []
+    with app.db_connection() as conn:
+        conn.set_trace_callback(statements.append)
+
+    client = app.app.test_client()
+    with client.session_transaction() as s:
+        s["username"] = "teacher"
+    client.get("/teacher_analytics")
+
+    with app.db_connection() as conn:
+        conn.set_trace_callback(None)
+    return len(statements)
+
+
+def main():
+    failed = False
+    with app.db_connection() as conn:
+        for name, (sql, params) in HOT_QUERIES.items():
+            scans = full_scans(conn, sql, params)
+            status = "FULL SCAN" if scans else "ok"
+            print(f"{name:<28} {status}")
+            failed = failed or bool(scans)
+
+    small, large = count_dashboard_queries(1), count_dashboard_queries(50)
+    status = "ok" if small == large else "N+1"
+    print(f"{'teacher_analytics queries':<28} {status} (1 位學生: {small}, 50 位學生: {large})")
+    failed = failed or small != large
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+模擬 OpenAI 相容的 /chat/completions 伺服器，供壓力測試使用。
+
+依請求內容回傳對應格式的固定回覆（鷹架分析 JSON、合併模式 JSON、弱點分析 JSON、
+關鍵詞或一般回答），並依 --latency 指定的分布模擬延遲；支援 stream=True 與
+stream_options.include_usage。GET /stats 回傳已處理的請求數。
+
+延遲分布格式（毫秒）：
+    fixed:400            固定 400ms
+    uniform:200:800      200～800ms 均勻分布
+    lognormal:400:0.5    中位數 400ms、sigma 0.5 的對數常態分布（有長尾，較接近真實 API）
+
+執行方式（於專案根目錄）：
+    python benchmarks/fake_openai_server.py --port 8900 --latency lognormal:400:0.5
+    LLM_BASE_URL=http://127.0.0.1:8900/v1 python app.py
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ANALYSIS = {
+    "scaffolding_type": "重複鷹架",
+    "understanding_level": "初學者",
+    "reason": "學生需要鞏固基本概念",
+}
+WEAKNESS = {
+    "weakness": "對模型評估指標的理解不夠穩固",
+    "suggestions": ["複習混淆矩陣", "練習計算精確率與召回率"],
+    "confidence": "中",
+}
+REPLY_TEXT = (
+    "過度擬合是模型把訓練資料的雜訊也學起來。就像死背考古題，換題目就不會。"
+    "可以用交叉驗證檢查泛化能力。你能想到其他避免的方法嗎？"
+)
+KEYWORDS_TEXT = "機器學習"
+STREAM_CHUNK_CHARS = 4
+
+
+def parse_latency(spec):
+    """把延遲分布字串轉成回傳毫秒數的函式"""
+    kind, *params = spec.split(":")
+    values = [float(p) for p in params]
+    if kind == "fixed" and len(values) == 1:
+        return lambda rng: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal" and len(values) == 2:
+        median, sigma = values
+        return lambda rng: median * rng.lognormvariate(0, sigma)
+    raise ValueError(f"無法解析延遲分布: {spec}")
+
+
+def canned_content(messages):
+    """依提示內容挑選回覆格式（與 app.py 中各呼叫點的提示對應）"""
+    system = messages[0]["content"] if messages else ""
+    prompt = messages[-1]["content"] if messages else ""
+    if '"reply"' in prompt:
+        return json.dumps(dict(ANALYSIS, reply=REPLY_TEXT), ensure_ascii=False)
+    if "弱點" in system or "weakness" in prompt:
+        return json.dumps(WEAKNESS, ensure_ascii=False)
+    if "JSON" in prompt or "JSON" in system:
+        return json.dumps(ANALYSIS, ensure_ascii=False)
+    if "關鍵詞" in system:
+        return KEYWORDS_TEXT
+    return REPLY_TEXT
+
+
+class FakeOpenAIState:
+    def __init__(self, latency, token_ms, error_rate, seed):
+        self.latency = latency
+        self.token_ms = token_ms
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.streams = 0
+
+    def draw(self):
+        """抽出這次請求的延遲（毫秒）與是否回傳錯誤"""
+        with self.lock:
+            self.requests += 1
+            fail = self.rng.random() < self.error_rate
+            if fail:
+                self.errors += 1
+            return self.latency(self.rng), fail
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "errors": self.errors, "streams": self.streams}
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None  # 由 start_server 設定
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            self._send_json(200, self.state.stats())
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+
+        latency_ms, fail = self.state.draw()
+        time.sleep(latency_ms / 1000)
+        if fail:
+            self._send_json(500, {"error": {"message": "simulated failure", "type": "server_error"}})
+            return
+
+        content = canned_content(body.get("messages", []))
+        model = body.get("model", "gpt-4o-mini")
+        # 粗估：中文一個字約一個 token
+        usage = {
+            "prompt_tokens": sum(len(m.get("content", "")) for m in body.get("messages", [])),
+            "completion_tokens": len(content),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+        if body.get("stream"):
+            include_usage = (body.get("stream_options") or {}).get("include_usage")
+            self._send_stream(model, content, usage if include_usage else None)
+            return
+
+        time.sleep(self.state.token_ms * len(content) / 1000)
+        self._send_json(
+            200,
+            {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": content},
+                    }
+                ],
+                "usage": usage,
+            },
+        )
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, model, content, usage):
+        with self.state.lock:
+            self.state.streams += 1
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def event(choices, usage=None):
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": choices,
+            }
+            if usage is not None:
+                chunk["usage"] = usage
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            self.wfile.flush()
+
+        for i in range(0, len(content), STREAM_CHUNK_CHARS):
+            piece = content[i : i + STREAM_CHUNK_CHARS]
+            time.sleep(self.state.token_ms * len(piece) / 1000)
+            event([{"index": 0, "delta": {"content": piece}, "finish_reason": None}])
+        event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if usage is not None:
+            event([], usage)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(host="127.0.0.1", port=0, latency="fixed:0", token_ms=0, error_rate=0, seed=42):
+    """在背景執行緒啟動伺服器，回傳 server（server.server_port 為實際埠號）"""
+    state = FakeOpenAIState(parse_latency(latency), token_ms, error_rate, seed)
+    handler = type("Handler", (FakeOpenAIHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", default="lognormal:400:0.5", help="每次呼叫的延遲分布")
+    parser.add_argument("--token-ms", type=float, default=0, help="每個輸出 token 的產生時間")
+    parser.add_argument("--error-rate", type=float, default=0, help="回傳 500 的比例")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    server = start_server(
+        args.host, args.port, args.latency, args.token_ms, args.error_rate, args.seed
+    )
+    print(f"fake OpenAI server: http://{args.host}:{server.server_port}/v1", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
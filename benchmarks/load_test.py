@@ -0,0 +1,357 @@
+"""
+端對端壓力測試：在合成資料庫上以多個已登入的學生與教師同時操作，量測各 API 的吞吐量與延遲。
+
+每個資料量（--sizes）各跑一次：
+  1. 以 make_synthetic_db.py 產生（或沿用 --data-dir 中已有的）合成 users.db，複製一份供本次使用
+  2. 啟動 fake_openai_server.py（延遲分布由 --llm-latency 指定），以 LLM_BASE_URL 指向它
+  3. 以 gunicorn（或 --server flask）在子行程啟動 app，避免與壓測端搶 GIL
+  4. --sessions 個學生依 --mix 的比例呼叫 /chat、/chat/history、/my_learning_analytics，
+     --teachers 個教師持續呼叫 /teacher_analytics；前 --warmup 秒不計入
+結果包含每個 API 的每秒完成數、p50/p95/p99 延遲與錯誤率，可用 --output 存成基準檔，
+下次以 --compare 比對（p95 或吞吐量變差超過 --tolerance、錯誤率增加超過 1% 時回傳 1）。
+
+執行方式（於專案根目錄）：
+    python benchmarks/load_test.py --sizes 10000,100000 --sessions 32 --duration 30 --output baseline.json
+    python benchmarks/load_test.py --sizes 10000,100000 --sessions 32 --duration 30 --compare baseline.json
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+STUDENT_PASSWORD = "password"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(sorted_values, p):
+    """nearest-rank 百分位數"""
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(p * len(sorted_values)) - 1)]
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        name, weight = part.split("=")
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+STUDENT_REQUESTS = {
+    "chat": ("POST", "/chat"),
+    "history": ("GET", "/chat/history"),
+    "my_learning": ("GET", "/my_learning_analytics"),
+}
+CHAT_MESSAGES = [
+    "什麼是過度擬合?",
+    "可以再解釋一次交叉驗證嗎",
+    "決策樹和隨機森林有什麼差別？",
+    "梯度下降的學習率要怎麼選",
+    "我還是不太懂標準化",
+]
+
+
+def ensure_database(args, conversations):
+    """沿用 --data-dir 中相同參數的資料庫，沒有才產生"""
+    os.makedirs(args.data_dir, exist_ok=True)
+    path = os.path.join(
+        args.data_dir, f"users_{conversations}_{args.students}_{args.seed}.db"
+    )
+    if not os.path.exists(path):
+        subprocess.run(
+            [
+                sys.executable,
+                os.path.join(BENCH_DIR, "make_synthetic_db.py"),
+                "--conversations", str(conversations),
+                "--students", str(args.students),
+                "--password", STUDENT_PASSWORD,
+                "--seed", str(args.seed),
+                "--output", path,
+            ],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+    return path
+
+
+def start_processes(args, db_path):
+    """啟動假 LLM 伺服器與 app，回傳 (行程清單, app 網址, 假伺服器網址)"""
+    llm_port, app_port = free_port(), free_port()
+    llm = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(BENCH_DIR, "fake_openai_server.py"),
+            "--port", str(llm_port),
+            "--latency", args.llm_latency,
+            "--token-ms", str(args.llm_token_ms),
+            "--error-rate", str(args.llm_error_rate),
+            "--seed", str(args.seed),
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    env = dict(
+        os.environ,
+        DB_NAME=db_path,
+        OPENAI_API_KEY="sk-loadtest",
+        LLM_BASE_URL=f"http://127.0.0.1:{llm_port}/v1",
+    )
+    if args.server == "gunicorn":
+        command = [
+            sys.executable, "-m", "gunicorn",
+            "--workers", str(args.workers),
+            "--threads", str(args.threads),
+            "--bind", f"127.0.0.1:{app_port}",
+            "--graceful-timeout", "5",
+            "--log-level", "warning",
+            "app:app",
+        ]
+    else:
+        command = [
+            sys.executable, "-m", "flask", "--app", "app", "run",
+            "--port", str(app_port), "--with-threads", "--no-reload", "--no-debugger",
+        ]
+    server = subprocess.Popen(
+        command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+    base_url = f"http://127.0.0.1:{app_port}"
+    llm_url = f"http://127.0.0.1:{llm_port}"
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(base_url + "/", timeout=2).status_code == 200:
+                requests.get(llm_url + "/stats", timeout=2).raise_for_status()
+                return [server, llm], base_url, llm_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    for p in (server, llm):
+        p.terminate()
+    raise RuntimeError("app 或假 LLM 伺服器啟動逾時")
+
+
+def login(base_url, username, password):
+    http = requests.Session()
+    r = http.post(
+        base_url + "/login",
+        data={"username": username, "password": password},
+        allow_redirects=False,
+        timeout=30,
+    )
+    if r.status_code != 302 or "session" not in http.cookies:
+        raise RuntimeError(f"{username} 登入失敗 ({r.status_code})")
+    return http
+
+
+def run_size(args, conversations):
+    source = ensure_database(args, conversations)
+    workdir = tempfile.mkdtemp()
+    db_path = os.path.join(workdir, "users.db")
+    shutil.copy(source, db_path)
+
+    with sqlite3.connect(db_path) as conn:
+        students = [
+            row[0]
+            for row in conn.execute("SELECT username FROM student_summary ORDER BY username")
+        ]
+    rng = random.Random(args.seed)
+    active = rng.sample(students, min(args.sessions, len(students)))
+
+    processes, base_url, llm_url = start_processes(args, db_path)
+    try:
+        sessions = [(name, login(base_url, name, STUDENT_PASSWORD)) for name in active]
+        teachers = [login(base_url, "teacher", "teacher") for _ in range(args.teachers)]
+
+        mix = parse_mix(args.mix)
+        kinds = list(mix)
+        weights = [mix[k] for k in kinds]
+        samples = defaultdict(list)  # 端點 -> [(延遲秒數, 是否成功)]
+        lock = threading.Lock()
+        start = time.monotonic()
+        measure_from = start + args.warmup
+        stop_at = measure_from + args.duration
+
+        def issue(http, method, path, **kwargs):
+            began = time.monotonic()
+            try:
+                ok = http.request(method, base_url + path, timeout=120, **kwargs).status_code < 400
+            except requests.RequestException:
+                ok = False
+            ended = time.monotonic()
+            if began >= measure_from and ended <= stop_at:
+                with lock:
+                    samples[path].append((ended - began, ok))
+
+        def student(http, seed):
+            local = random.Random(seed)
+            while time.monotonic() < stop_at:
+                method, path = STUDENT_REQUESTS[local.choices(kinds, weights)[0]]
+                if path == "/chat":
+                    issue(http, method, path, json={"message": local.choice(CHAT_MESSAGES)})
+                else:
+                    issue(http, method, path)
+
+        def teacher(http):
+            while time.monotonic() < stop_at:
+                issue(http, "GET", "/teacher_analytics")
+
+        threads = [
+            threading.Thread(target=student, args=(http, i))
+            for i, (_, http) in enumerate(sessions)
+        ]
+        threads += [threading.Thread(target=teacher, args=(http,)) for http in teachers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        llm_stats = requests.get(llm_url + "/stats", timeout=10).json()
+    finally:
+        for p in processes:
+            p.terminate()
+        for p in processes:
+            try:
+                p.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {}
+    for path, items in sorted(samples.items()):
+        latencies = sorted(s for s, _ in items)
+        errors = sum(1 for _, ok in items if not ok)
+        results[path] = {
+            "requests": len(items),
+            "errors": errors,
+            "error_rate": round(errors / len(items), 4),
+            "throughput_rps": round(len(items) / args.duration, 2),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        }
+    return {
+        "conversations": conversations,
+        "students": len(students),
+        "db_size_mb": round(os.path.getsize(source) / 1024 / 1024, 1),
+        "results": results,
+        "llm": llm_stats,
+    }
+
+
+def compare(runs, baseline, tolerance):
+    """與基準檔比較，回傳退步項目的清單"""
+    regressions = []
+    base_runs = {r["conversations"]: r for r in baseline["runs"]}
+    for run in runs:
+        base = base_runs.get(run["conversations"])
+        if base is None:
+            continue
+        for path, r in run["results"].items():
+            b = base["results"].get(path)
+            if b is None:
+                continue
+            checks = [
+                ("p95_ms", r["p95_ms"] > b["p95_ms"] * (1 + tolerance)),
+                ("throughput_rps", r["throughput_rps"] < b["throughput_rps"] * (1 - tolerance)),
+                ("error_rate", r["error_rate"] > b["error_rate"] + 0.01),
+            ]
+            for metric, worse in checks:
+                print(
+                    f"{run['conversations']:>8} {path:>24} {metric:>15}: "
+                    f"{b[metric]} -> {r[metric]}{'  退步' if worse else ''}"
+                )
+                if worse:
+                    regressions.append((run["conversations"], path, metric))
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="10000", help="對話筆數，以逗號分隔，例如 10000,100000,1000000")
+    parser.add_argument("--students", type=int, default=300, help="合成資料中的學生人數")
+    parser.add_argument("--sessions", type=int, default=32, help="同時操作的學生數")
+    parser.add_argument("--teachers", type=int, default=2, help="同時查詢儀表板的教師數")
+    parser.add_argument("--mix", default="chat=5,history=3,my_learning=1", help="學生請求的比例")
+    parser.add_argument("--duration", type=float, default=30, help="量測秒數")
+    parser.add_argument("--warmup", type=float, default=5, help="不計入結果的暖機秒數")
+    parser.add_argument("--llm-latency", default="lognormal:400:0.5", help="假 LLM 的延遲分布")
+    parser.add_argument("--llm-token-ms", type=float, default=0, help="假 LLM 每個輸出 token 的時間")
+    parser.add_argument("--llm-error-rate", type=float, default=0, help="假 LLM 回傳 500 的比例")
+    parser.add_argument("--server", choices=["gunicorn", "flask"], default="gunicorn")
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn worker 數")
+    parser.add_argument("--threads", type=int, default=32, help="gunicorn 每個 worker 的執行緒數")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "system-loadtest"))
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="將結果寫成 JSON 基準檔")
+    parser.add_argument("--compare", help="與先前的 JSON 基準檔比較")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允許的退步比例")
+    args = parser.parse_args()
+
+    runs = []
+    for size in (int(s) for s in args.sizes.split(",")):
+        run = run_size(args, size)
+        runs.append(run)
+        print(f"== {size} 筆對話 / {run['students']} 位學生 ({run['db_size_mb']}MB), LLM 請求 {run['llm']['requests']}")
+        for path, r in run["results"].items():
+            print(
+                f"{path:>24}: {r['throughput_rps']}/s p50={r['p50_ms']}ms "
+                f"p95={r['p95_ms']}ms p99={r['p99_ms']}ms errors={r['error_rate']:.2%}"
+            )
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "config": vars(args),
+        },
+        "runs": runs,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(runs, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} 項退步超過門檻")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+產生壓力測試用的合成 users.db。
+
+以 app.py 的遷移建立完整結構，再寫入指定數量的學生帳號與對話紀錄：
+學生活躍度呈長尾分布（少數重度使用者占多數對話），訊息由各學習單元的關鍵詞組成，
+時間戳記依 id 遞增、平均分散在最近 --days 天內，最後重建摘要表與每日彙總表。
+所有學生的密碼都是 --password（預設 password），teacher 帳號密碼為 teacher。
+
+執行方式（於專案根目錄）：
+    python benchmarks/make_synthetic_db.py --conversations 100000 --students 300 --output /tmp/users_100k.db
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+os.environ["DB_NAME"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+os.environ["JOB_WORKERS"] = "0"  # 不啟動背景工作 worker，避免干擾量測
+
+import app  # noqa: E402
+
+SCAFFOLDS = ["差異鷹架", "重複鷹架", "協同鷹架"]
+LEVELS = ["初學者", "進階學習者", "熟練者"]
+TEMPLATES = [
+    "什麼是{kw}?",
+    "可以再解釋一次{kw}嗎",
+    "{kw}和{other}有什麼差別？",
+    "老師，{kw}在實務上要怎麼用",
+    "為什麼{kw}會影響模型的結果",
+    "我還是不太懂{kw}",
+]
+REPLY = "這是合成資料的回覆，說明相關概念並引導學生思考下一步。"
+BATCH_SIZE = 50000
+
+
+def student_names(students):
+    width = max(4, len(str(students - 1)))
+    return [f"student{i:0{width}d}" for i in range(students)]
+
+
+def generate_conversations(names, conversations, days, rng):
+    """依時間順序產生 (username, user_message, bot_reply, unit, scaffold, level, reason, timestamp)"""
+    # 長尾分布：Pareto 權重讓少數學生有數千筆對話
+    weights = [rng.paretovariate(1.5) for _ in names]
+    cumulative = []
+    total = 0
+    for w in weights:
+        total += w
+        cumulative.append(total)
+
+    units = list(app.LEARNING_UNITS)
+    keywords = {u: app.LEARNING_UNITS[u]["keywords"] for u in units}
+    start = datetime.now(timezone.utc) - timedelta(days=days)
+    step = days * 86400 / max(conversations, 1)
+
+    for i in range(conversations):
+        username = rng.choices(names, cum_weights=cumulative)[0]
+        unit = rng.choice(units)
+        kw, other = rng.sample(keywords[unit], 2)
+        message = rng.choice(TEMPLATES).format(kw=kw, other=other)
+        moment = start + timedelta(seconds=i * step + rng.random() * step)
+        yield (
+            username,
+            message,
+            REPLY,
+            unit,
+            rng.choice(SCAFFOLDS),
+            rng.choice(LEVELS),
+            "合成資料",
+            moment.strftime("%Y-%m-%d %H:%M:%S"),
+        )
+
+
+def build_synthetic_db(path, conversations, students, days=180, password="password", seed=42):
+    """建立合成資料庫並回傳摘要資訊"""
+    if os.path.exists(path):
+        os.remove(path)
+    started = time.perf_counter()
+    rng = random.Random(seed)
+
+    app.DB_NAME = path
+    app.init_db()
+
+    names = student_names(students)
+    conn = app.sqlite3.connect(path)
+    conn.execute("PRAGMA synchronous = OFF")
+    hashed = app.hash_password(password)
+    conn.executemany(
+        "INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)",
+        ((name, hashed) for name in names),
+    )
+
+    rows = generate_conversations(names, conversations, days, rng)
+    while True:
+        batch = [row for _, row in zip(range(BATCH_SIZE), rows)]
+        if not batch:
+            break
+        conn.executemany(
+            """INSERT INTO conversations
+               (username, user_message, bot_reply, learning_unit, scaffolding_type,
+                understanding_level, analysis_reason, timestamp)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            batch,
+        )
+        conn.commit()
+
+    cursor = conn.cursor()
+    app.rebuild_student_summary(cursor)
+    app.rebuild_daily_activity(cursor)
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+
+    return {
+        "path": path,
+        "conversations": conversations,
+        "students": students,
+        "days": days,
+        "size_mb": round(os.path.getsize(path) / 1024 / 1024, 1),
+        "build_seconds": round(time.perf_counter() - started, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--conversations", type=int, default=10000)
+    parser.add_argument("--students", type=int, default=300)
+    parser.add_argument("--days", type=int, default=180, help="對話分散的天數")
+    parser.add_argument("--password", default="password", help="所有學生帳號的密碼")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", required=True, help="輸出的資料庫路徑（已存在會被覆蓋）")
+    args = parser.parse_args()
+
+    info = build_synthetic_db(
+        args.output, args.conversations, args.students, args.days, args.password, args.seed
+    )
+    print(
+        f"{info['path']}: {info['conversations']} 筆對話 / {info['students']} 位學生, "
+        f"{info['size_mb']}MB, {info['build_seconds']}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
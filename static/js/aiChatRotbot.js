@@ -5,6 +5,8 @@ document.getElementById('clearBtn').addEventListener('click', async () => {
     // 清除畫面訊息
     chatMessages.innerHTML = '';
     chatInput.value = '';
+    historyStart = null;
+    hasOlder = false;
 
     // 呼叫後端清除 API
     try {
@@ -22,13 +24,131 @@ document.getElementById('clearBtn').addEventListener('click', async () => {
     }
 });
 
-// 加入訊息到畫面
-function addMessage(role, content) {
+// 建立訊息泡泡
+function createBubble(role, content) {
     const div = document.createElement('div');
     div.classList.add('bubble', role);
     div.textContent = content;
+    return div;
+}
+
+// 加入訊息到畫面
+function addMessage(role, content) {
+    const div = createBubble(role, content);
     chatMessages.appendChild(div);
     chatMessages.scrollTop = chatMessages.scrollHeight;
+    return div;
+}
+
+// 對話紀錄分頁狀態：historyStart 是畫面上最早的一則紀錄，更早的頁面插在它前面
+let historyStart = null;
+let oldestId = null;
+let latestId = null;
+let hasOlder = false;
+let loadingOlder = false;
+let historyLoaded = false;
+const shownIds = new Set();
+
+async function fetchHistory(params) {
+    const res = await fetch('/chat/history?' + new URLSearchParams(params));
+    return await res.json();
+}
+
+// 往上捲到頂端時載入更早的一頁，並維持目前的捲動位置
+async function loadOlderHistory() {
+    if (!hasOlder || loadingOlder) return;
+    loadingOlder = true;
+    try {
+        const page = await fetchHistory({ before: oldestId });
+        if (!Array.isArray(page.messages)) return;
+
+        const fragment = document.createDocumentFragment();
+        for (const msg of page.messages) {
+            fragment.appendChild(createBubble(msg.role, msg.content));
+        }
+        const first = fragment.firstChild;
+        const previousHeight = chatMessages.scrollHeight;
+        chatMessages.insertBefore(fragment, historyStart);
+        chatMessages.scrollTop += chatMessages.scrollHeight - previousHeight;
+
+        historyStart = first || historyStart;
+        oldestId = page.oldest_id ?? oldestId;
+        hasOlder = page.has_more;
+    } catch (err) {
+        console.error('載入更早的紀錄失敗:', err);
+    } finally {
+        loadingOlder = false;
+    }
+}
+
+// 只取 latestId 之後的新對話（例如在影片頁聊過後切回這個分頁）
+async function syncNewHistory() {
+    if (!historyLoaded) return;
+    let page;
+    do {
+        page = await fetchHistory({ since: latestId ?? 0 });
+        if (!Array.isArray(page.messages)) return;
+        for (const msg of page.messages) {
+            if (!shownIds.has(msg.id)) addMessage(msg.role, msg.content);
+        }
+        latestId = page.latest_id ?? latestId;
+    } while (page.has_more);
+}
+
+chatMessages.addEventListener('scroll', () => {
+    if (chatMessages.scrollTop < 40) loadOlderHistory();
+});
+
+document.addEventListener('visibilitychange', () => {
+    if (document.visibilityState === 'visible') {
+        syncNewHistory().catch(err => console.error('同步對話紀錄失敗:', err));
+    }
+});
+
+// 以 SSE 串流接收 AI 回覆，每收到一段文字就呼叫 onToken
+async function streamChat(text, onToken) {
+    const response = await fetch('/chat/stream', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ message: text }),
+    });
+
+    if (!response.ok || !response.body) {
+        return await response.json();
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let result = {};
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+
+        for (const raw of events) {
+            let event = 'message';
+            let data = '';
+            for (const line of raw.split('\n')) {
+                if (line.startsWith('event: ')) event = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            }
+            if (!data) continue;
+
+            const payload = JSON.parse(data);
+            if (event === 'token') {
+                onToken(payload.text);
+            } else if (event === 'done' || event === 'error') {
+                result = payload;
+            }
+        }
+    }
+
+    return result;
 }
 
 // 載入初始 AI 訊息
@@ -55,23 +175,35 @@ chatForm.addEventListener('submit', async function (e) {
     chatMessages.appendChild(typingBubble);
     chatMessages.scrollTop = chatMessages.scrollHeight;
 
-    // 呼叫後端 API
+    // 呼叫後端串流 API，收到第一段文字就開始顯示
     try {
-        const response = await fetch('/chat', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ message: text }),
-        });
+        let replyBubble = null;
+        let streamed = '';
 
-        const data = await response.json();
+        const data = await streamChat(text, (token) => {
+            if (!replyBubble) {
+                const typingEl = document.getElementById('typingIndicator');
+                if (typingEl) typingEl.remove();
+                replyBubble = addMessage('ai', '');
+            }
+            streamed += token;
+            replyBubble.textContent = streamed;
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+        });
 
         // 移除輸入中動畫
         const typingEl = document.getElementById('typingIndicator');
         if (typingEl) typingEl.remove();
 
-        // 顯示 AI 回覆
+        if (data.conversation_id) shownIds.add(data.conversation_id);
+
+        // 顯示 AI 最終回覆
         if (data.reply) {
-            addMessage('ai', data.reply);
+            if (replyBubble) {
+                replyBubble.textContent = data.reply;
+            } else {
+                addMessage('ai', data.reply);
+            }
         } else if (data.error) {
             addMessage('ai', '錯誤：' + data.error);
         }
@@ -88,13 +220,17 @@ chatForm.addEventListener('submit', async function (e) {
 // 載入初始訊息 & 歷史紀錄
 window.addEventListener('DOMContentLoaded', async () => {
     try {
-        const res = await fetch('/chat/history');
-        const history = await res.json();
+        const history = await fetchHistory({});
 
-        if (Array.isArray(history)) {
-            for (const msg of history) {
-                addMessage(msg.role, msg.content);
+        if (Array.isArray(history.messages)) {
+            for (const msg of history.messages) {
+                const bubble = addMessage(msg.role, msg.content);
+                historyStart = historyStart || bubble;
             }
+            oldestId = history.oldest_id;
+            latestId = history.latest_id;
+            hasOlder = history.has_more;
+            historyLoaded = true;
         } else if (history.error) {
             addMessage('ai', '⚠️ 無法載入歷史紀錄：' + history.error);
         }
@@ -1,6 +1,7 @@
 let progressChart = null;
 let scaffoldingChart = null; // 新增
 let isLoading = false;
+let weaknessPollTimer = null;
 
 async function loadMyAnalytics() {
     if (isLoading) return;
@@ -44,6 +45,12 @@ async function loadMyAnalytics() {
         // 顯示學習時間軸
         displayTimeline(data.timeline);
 
+        // 有單元的弱點分析還在背景工作佇列中，輪詢進度，完成後重新載入；
+        // 分析失敗（failed）的單元不會再排入工作，只有它們時不輪詢，避免重新載入的迴圈
+        if (Object.values(data.weakness_sources || {}).includes('pending')) {
+            pollWeaknessStatus();
+        }
+
     } catch (error) {
         console.error('載入數據失敗:', error);
         showError('載入數據時發生錯誤：' + error.message);
@@ -53,6 +60,27 @@ async function loadMyAnalytics() {
     }
 }
 
+function pollWeaknessStatus() {
+    if (weaknessPollTimer) return;
+
+    weaknessPollTimer = setTimeout(async () => {
+        weaknessPollTimer = null;
+        try {
+            const response = await fetch('/my_learning/weakness_status');
+            if (!response.ok) return;
+
+            const status = await response.json();
+            if (status.done) {
+                loadMyAnalytics();
+            } else {
+                pollWeaknessStatus();
+            }
+        } catch (error) {
+            console.error('查詢弱點分析進度失敗:', error);
+        }
+    }, 3000);
+}
+
 function showError(message) {
     const errorContainer = document.getElementById('error-container');
     errorContainer.innerHTML = `<div class="error-message">${message}</div>`;
@@ -1,5 +1,7 @@
 let charts = {}; // 儲存圖表實例
 let isLoading = false; // 防止重複載入
+let lastEtag = null; // 上次載入資料的 ETag，資料沒變時伺服器回 304
+let lastWindow = null;
 
 // 按下 重新載入的按鈕 會跑這個function
 async function loadAnalytics() {
@@ -13,18 +15,31 @@ async function loadAnalytics() {
         // 清除錯誤訊息
         document.getElementById('error-container').innerHTML = '';
 
-        // 顯示載入狀態
-        document.getElementById('studentTableBody').innerHTML =
-            '<tr><td colspan="6" class="loading"><span class="loading-spinner"></span> 載入中...</td></tr>';
+        // 第一次載入時顯示載入狀態（之後的輪詢可能回 304，保留原本的表格）
+        if (!lastEtag) {
+            document.getElementById('studentTableBody').innerHTML =
+                '<tr><td colspan="6" class="loading"><span class="loading-spinner"></span> 載入中...</td></tr>';
+        }
 
         // 跟後端要資料 基本統計數據、鷹架類型統計之類的 8===D
-        const response = await fetch('/teacher_analytics', {
+        // 每日活動的時間範圍（7 / 30 / 90 天或本學期）
+        const activityWindow = document.getElementById('activityWindow').value;
+        const headers = { 'Content-Type': 'application/json' };
+        if (lastEtag && activityWindow === lastWindow) {
+            headers['If-None-Match'] = lastEtag;
+        }
+
+        const response = await fetch(`/teacher_analytics?window=${activityWindow}`, {
             method: 'GET',
-            headers: {
-                'Content-Type': 'application/json',
-            }
+            headers: headers,
+            cache: 'no-store',
         });
 
+        // 資料沒有變動，保留目前畫面
+        if (response.status === 304) {
+            return;
+        }
+
         if (!response.ok) {
             throw new Error(`HTTP ${response.status}: ${response.statusText}`);
         }
@@ -35,6 +50,9 @@ async function loadAnalytics() {
             throw new Error(data.error);
         }
 
+        lastEtag = response.headers.get('ETag');
+        lastWindow = activityWindow;
+
         // 更新統計卡片
         updateStatsCards(data.stats || {});
 
@@ -357,6 +375,9 @@ function formatDate(dateString) {
 // 頁面載入時執行
 document.addEventListener('DOMContentLoaded', () => {
     loadAnalytics();
+
+    // 切換每日活動的時間範圍時重新載入
+    document.getElementById('activityWindow').addEventListener('change', loadAnalytics);
 });
 
 // 每5分鐘自動重新載入數據
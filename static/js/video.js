@@ -86,9 +86,8 @@ function formatMessage(text) {
     return tempDiv.innerHTML;
 }
 
-// 加入訊息至聊天框（改進版，支援時間戳記）
-function addMessage(sender, text, showTimestamp = false) {
-    const chatMessages = document.getElementById('chat-messages');
+// 建立一列訊息（不加入畫面）
+function createMessageRow(sender, text, showTimestamp = false) {
     const messageRow = document.createElement("div");
     messageRow.classList.add("message-row", sender);
 
@@ -113,6 +112,15 @@ function addMessage(sender, text, showTimestamp = false) {
         messageRow.appendChild(timestamp);
     }
 
+    return messageRow;
+}
+
+// 加入訊息至聊天框（改進版，支援時間戳記）
+function addMessage(sender, text, showTimestamp = false) {
+    const chatMessages = document.getElementById('chat-messages');
+    const messageRow = createMessageRow(sender, text, showTimestamp);
+    const bubble = messageRow.querySelector('.bubble');
+
     chatMessages.appendChild(messageRow);
 
     // 平滑滾動到底部
@@ -120,6 +128,120 @@ function addMessage(sender, text, showTimestamp = false) {
         top: chatMessages.scrollHeight,
         behavior: 'smooth'
     });
+
+    return bubble;
+}
+
+// 對話紀錄分頁狀態：historyStart 是畫面上最早的一列紀錄，更早的頁面插在它前面
+let historyStart = null;
+let oldestId = null;
+let latestId = null;
+let hasOlder = false;
+let loadingOlder = false;
+let historyLoaded = false;
+const shownIds = new Set();
+
+async function fetchHistory(params) {
+    const res = await fetch('/chat/history?' + new URLSearchParams(params));
+    return await res.json();
+}
+
+// 往上捲到頂端時載入更早的一頁，並維持目前的捲動位置
+async function loadOlderHistory() {
+    if (!hasOlder || loadingOlder) return;
+    loadingOlder = true;
+    const chatMessages = document.getElementById('chat-messages');
+    try {
+        const page = await fetchHistory({ before: oldestId });
+        if (!Array.isArray(page.messages)) return;
+
+        const fragment = document.createDocumentFragment();
+        for (const msg of page.messages) {
+            if (msg.content !== '[已清除]') {
+                fragment.appendChild(createMessageRow(msg.role, msg.content));
+            }
+        }
+        const first = fragment.firstChild;
+        const previousHeight = chatMessages.scrollHeight;
+        chatMessages.insertBefore(fragment, historyStart);
+        chatMessages.scrollTop += chatMessages.scrollHeight - previousHeight;
+
+        historyStart = first || historyStart;
+        oldestId = page.oldest_id ?? oldestId;
+        hasOlder = page.has_more;
+    } catch (err) {
+        console.error('載入更早的紀錄失敗:', err);
+    } finally {
+        loadingOlder = false;
+    }
+}
+
+// 只取 latestId 之後的新對話（例如在聊天頁聊過後切回這個分頁）
+async function syncNewHistory() {
+    if (!historyLoaded) return;
+    let page;
+    do {
+        page = await fetchHistory({ since: latestId ?? 0 });
+        if (!Array.isArray(page.messages)) return;
+        for (const msg of page.messages) {
+            if (!shownIds.has(msg.id) && msg.content !== '[已清除]') {
+                addMessage(msg.role, msg.content);
+            }
+        }
+        latestId = page.latest_id ?? latestId;
+    } while (page.has_more);
+}
+
+document.addEventListener('visibilitychange', () => {
+    if (document.visibilityState === 'visible') {
+        syncNewHistory().catch(err => console.error('同步對話紀錄失敗:', err));
+    }
+});
+
+// 以 SSE 串流接收 AI 回覆，每收到一段文字就呼叫 onToken
+async function streamChat(text, onToken) {
+    const response = await fetch('/chat/stream', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ message: text }),
+    });
+
+    if (!response.ok || !response.body) {
+        return await response.json();
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let result = {};
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+
+        for (const raw of events) {
+            let event = 'message';
+            let data = '';
+            for (const line of raw.split('\n')) {
+                if (line.startsWith('event: ')) event = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            }
+            if (!data) continue;
+
+            const payload = JSON.parse(data);
+            if (event === 'token') {
+                onToken(payload.text);
+            } else if (event === 'done' || event === 'error') {
+                result = payload;
+            }
+        }
+    }
+
+    return result;
 }
 
 // 綜合所有 DOMContentLoaded 的初始化內容
@@ -189,15 +311,24 @@ window.addEventListener("DOMContentLoaded", function () {
 
     // 初始歡迎訊息與歷史紀錄載入
     addMessage('ai', '你好！有什麼我可以幫忙的嗎？');
-    fetch('/chat/history')
-        .then(res => res.json())
+    const chatMessages = document.getElementById('chat-messages');
+    chatMessages.addEventListener('scroll', () => {
+        if (chatMessages.scrollTop < 40) loadOlderHistory();
+    });
+
+    fetchHistory({})
         .then(history => {
-            if (Array.isArray(history)) {
-                for (const msg of history) {
+            if (Array.isArray(history.messages)) {
+                for (const msg of history.messages) {
                     if (msg.content !== '[已清除]') {
-                        addMessage(msg.role, msg.content);
+                        const bubble = addMessage(msg.role, msg.content);
+                        historyStart = historyStart || bubble.parentElement;
                     }
                 }
+                oldestId = history.oldest_id;
+                latestId = history.latest_id;
+                hasOlder = history.has_more;
+                historyLoaded = true;
             } else if (history.error) {
                 addMessage('ai', '⚠️ 無法載入歷史紀錄：' + history.error);
             }
@@ -299,6 +430,8 @@ clearBtn.addEventListener('click', async () => {
 
     chatMessages.innerHTML = '';
     chatInput.value = '';
+    historyStart = null;
+    hasOlder = false;
 
     const booksList = document.getElementById('booksList');
     booksList.innerHTML = '<div class="no-books">開始對話即可獲得書籍推薦 ✨</div>';
@@ -349,25 +482,37 @@ chatForm.addEventListener('submit', async function (e) {
     chatMessages.scrollTop = chatMessages.scrollHeight;
 
     try {
-        // 同時發送聊天和書籍推薦請求
-        const [chatResponse] = await Promise.all([
-            fetch('/chat', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ message: text }),
+        let replyBubble = null;
+        let streamed = '';
+
+        // 同時發送聊天（串流）和書籍推薦請求
+        const [chatData] = await Promise.all([
+            streamChat(text, (token) => {
+                if (!replyBubble) {
+                    const typingEl = document.getElementById("typingIndicator");
+                    if (typingEl) typingEl.remove();
+                    replyBubble = addMessage('ai', '');
+                }
+                streamed += token;
+                replyBubble.textContent = streamed;
+                chatMessages.scrollTop = chatMessages.scrollHeight;
             }),
             getBookRecommendations(text)
         ]);
 
-        const chatData = await chatResponse.json();
-
         // 移除輸入中提示
         const typingEl = document.getElementById("typingIndicator");
         if (typingEl) typingEl.remove();
 
-        // 加入 AI 真正的回覆
+        if (chatData.conversation_id) shownIds.add(chatData.conversation_id);
+
+        // 加入 AI 真正的回覆（串流結束後換成排版好的版本）
         if (chatData.reply) {
-            addMessage('ai', chatData.reply);
+            if (replyBubble) {
+                replyBubble.innerHTML = formatMessage(chatData.reply);
+            } else {
+                addMessage('ai', chatData.reply);
+            }
         } else if (chatData.error) {
             addMessage('ai', '錯誤：' + chatData.error);
         }